@@ -0,0 +1,782 @@
+"""Offline benchmarks of the card generation.
+
+Synthetic students and photos are generated into a temporary folder,
+so the benchmarks do not need any real data or network access.
+Results are printed as JSON, so they can be compared between commits.
+
+    python3 benchmark.py stages --count 100 --resolution 4000x3000
+    python3 benchmark.py memory --counts 50 500 --resolution 1600x1200
+    python3 benchmark.py startup --count 5 --repeat 10
+    python3 benchmark.py backends --photos pictures/ --detect-max-side 640
+    python3 benchmark.py pdf --count 500 --unique-photos 100
+    python3 benchmark.py csv --count 10000
+    python3 benchmark.py scaling --photos pictures/ --detect-max-sides 1024 640
+    python3 benchmark.py service --requests 20 --concurrency 4
+"""
+import argparse
+import csv
+import hashlib
+import json
+import mimetypes
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image, ImageDraw, ImageOps
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_resolution(value: str) -> tuple:
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def synthetic_photo(path: os.path, resolution: tuple, seed: int) -> None:
+    """Saves a unique portrait-like JPEG, the content does not need
+    to contain a real face for measuring time and memory."""
+    rnd = random.Random(seed)
+    width, height = resolution
+    img = Image.new("RGB", resolution, tuple(rnd.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    # Head and body
+    draw.ellipse((width * 0.3, height * 0.15, width * 0.7, height * 0.6),
+                 fill=(224, 172, 105))
+    draw.rectangle((width * 0.2, height * 0.65, width * 0.8, height),
+                   fill=tuple(rnd.randrange(256) for _ in range(3)))
+    # Some noise so that every photo compresses differently
+    for _ in range(200):
+        x, y = rnd.randrange(width), rnd.randrange(height)
+        r = rnd.randrange(5, max(6, width // 20))
+        draw.ellipse((x, y, x + r, y + r),
+                     fill=tuple(rnd.randrange(256) for _ in range(3)))
+    img.save(path, "JPEG", quality=90)
+
+
+def synthetic_students(folder: os.path, count: int, resolution: tuple,
+                       unique_photos: int = None) -> os.path:
+    """Creates students.csv with count students in the given folder.
+    At most unique_photos different photos are generated and reused."""
+    unique_photos = min(count, unique_photos or count)
+    photos = list()
+    for idx in range(unique_photos):
+        path = os.path.join(folder, f"photo-{idx}.jpg")
+        if not os.path.exists(path):
+            synthetic_photo(path, resolution, idx)
+        photos.append(path)
+
+    csv_path = os.path.join(folder, f"students-{count}.csv")
+    with open(csv_path, "w") as f:
+        csv_writer = csv.writer(f)
+        for idx in range(count):
+            csv_writer.writerow([f"Student {idx}", "01  02  00", "Czech",
+                                 "17  10  26", photos[idx % unique_photos]])
+    return csv_path
+
+
+def synthetic_form(folder: os.path, photos: list) -> os.path:
+    """Creates a form export like the one from Google Forms, the photo
+    links point to file IDs that the local drive server understands."""
+    csv_path = os.path.join(folder, "form.csv")
+    with open(csv_path, "w") as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(["Timestamp", "Name", "Country", "Date of Birth", "Photo"])
+        for idx in range(len(photos)):
+            csv_writer.writerow(["2024-09-01", f"Student {idx}", "czech", "02/01/2000",
+                                 f"https://drive.google.com/open?id={idx}"])
+    return csv_path
+
+
+@contextmanager
+def local_drive(photos: list):
+    """Local HTTP server standing in for the Drive API,
+    file ID is the index of the photo in the list."""
+    def metadata(path: str) -> bytes:
+        file_id = path.split("/files/")[1].split("?")[0]
+        with open(photos[int(file_id)], "rb") as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        return json.dumps({"id": file_id, "md5Checksum": md5,
+                           "mimeType": mimetypes.guess_type(photos[int(file_id)])[0]}).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            file_id = int(self.path.split("/files/")[1].split("?")[0])
+            with open(photos[file_id], "rb") as f:
+                data = f.read()
+            self.send_response(200)
+            self.send_header("Content-Type", mimetypes.guess_type(photos[file_id])[0])
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            """Batch request with a metadata lookup in each part."""
+            body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+            parts = list()
+            for line in body.split("\r\n"):
+                if line.startswith("GET "):
+                    parts.append(b"--response\r\nContent-Type: application/http\r\n\r\n"
+                                 b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n"
+                                 + metadata(line.split()[1]) + b"\r\n")
+            data = b"".join(parts) + b"--response--\r\n"
+            self.send_response(200)
+            self.send_header("Content-Type", "multipart/mixed; boundary=response")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+
+
+class StageTimer:
+    """Sums wall time of the named stages."""
+
+    def __init__(self) -> None:
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def __call__(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[stage] += time.perf_counter() - start
+            self.counts[stage] += 1
+
+    def report(self, items: int) -> dict:
+        """Total time of each stage and the number of photos
+        or students it could process per second."""
+        return {stage: {"total_s": round(total, 4),
+                        "calls": self.counts[stage],
+                        "per_second": round(items / total, 2) if total else None}
+                for stage, total in self.totals.items()}
+
+
+def prepare_workdir(folder: os.path) -> None:
+    """Links the resources generate.py loads relative to the working
+    directory, so the cache and decisions stay in the benchmark folder."""
+    for name in ("fonts", "haarcascade_frontalface_default.xml"):
+        link = os.path.join(folder, name)
+        if not os.path.exists(link):
+            os.symlink(os.path.join(REPO_DIR, name), link)
+
+
+def run_generate(args: list, folder: os.path) -> dict:
+    """Runs generate.py in a separate process and returns its peak memory.
+    Synthetic photos may get several faces detected, the first one is
+    always chosen so the run never waits for the user."""
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "_generate", *args],
+        cwd=folder, input="0\n" * 100000, check=True,
+        capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def child_generate(args: list) -> None:
+    """Entry point of the process started by run_generate."""
+    import logging
+    sys.argv = ["generate.py", *args]
+    sys.path.insert(0, REPO_DIR)
+    from generate import Generate
+    logging.disable(logging.INFO)
+    Generate().run()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kB on Linux, the result goes on a separate line
+    # after any decision prompts
+    print("\n" + json.dumps({"peak_rss_kb": usage.ru_maxrss}))
+
+
+def bench_memory(args: argparse.Namespace, folder: os.path) -> dict:
+    """Peak memory of the photo PDF generation with and without streaming.
+    Fails when the peak memory with --stream grows with the number of
+    students by more than --max-growth."""
+    runs = list()
+    for count in args.counts:
+        csv_path = synthetic_students(folder, count, args.resolution,
+                                      args.unique_photos)
+        for stream in (False, True):
+            # The fastest detection is used, only the memory is measured here
+            gen_args = ["-m", "photo", "-p", csv_path, "-w", "1", "--no-cache",
+                        "--detect-preset", "fast", "--detect-max-side", "640",
+                        "-o", os.path.join(folder, "output.pdf")]
+            if stream:
+                gen_args.append("--stream")
+            result = run_generate(gen_args, folder)
+            result.update(count=count, stream=stream,
+                          resolution="x".join(map(str, args.resolution)),
+                          pdf_bytes=os.path.getsize(
+                              os.path.join(folder, "output.pdf")))
+            runs.append(result)
+            print(json.dumps(result), file=sys.stderr)
+
+    streamed = sorted((run for run in runs if run["stream"]), key=lambda run: run["count"])
+    growth_mb = (streamed[-1]["peak_rss_kb"] - streamed[0]["peak_rss_kb"]) / 1024
+    return {
+        "runs": runs,
+        "stream_growth_mb": round(growth_mb, 1),
+        "passed": growth_mb <= args.max_growth,
+    }
+
+
+def bench_startup(args: argparse.Namespace, folder: os.path) -> dict:
+    """Wall time of short runs of the command line tools, dominated by
+    imports and setup: a text sheet for a few students, and a download
+    run where all pictures are already present."""
+    csv_path = synthetic_students(folder, args.count, (400, 300))
+    photos = sorted(os.path.join(folder, f) for f in os.listdir(folder)
+                    if f.startswith("photo-"))
+    form_path = synthetic_form(folder, photos)
+    os.makedirs(os.path.join(folder, "pictures"), exist_ok=True)
+    for idx, photo in enumerate(photos):
+        link = os.path.join(folder, "pictures", f"Student {idx}.jpg")
+        if not os.path.exists(link):
+            os.symlink(photo, link)
+
+    commands = {
+        "generate_text": [os.path.join(REPO_DIR, "generate.py"), "-m", "text",
+                          "-p", csv_path, "-o", os.path.join(folder, "output.pdf")],
+        "download_present": [os.path.join(REPO_DIR, "download_images.py"), form_path],
+    }
+    results = dict()
+    for name, command in commands.items():
+        times = list()
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *command], cwd=folder, check=True,
+                           capture_output=True)
+            times.append(time.perf_counter() - start)
+        times.sort()
+        results[name] = {"min_s": round(times[0], 4),
+                         "median_s": round(times[len(times) // 2], 4)}
+    return results
+
+
+def bench_backends(args: argparse.Namespace, folder: os.path) -> dict:
+    """Detection time and the share of photos with no face, one face and
+    multiple faces for each backend. Multiple faces need a decision,
+    so their rate is what makes unattended runs stall."""
+    sys.path.insert(0, REPO_DIR)
+    import logging
+    from config import Config
+    from facedetector import FaceDetector
+    logging.disable(logging.WARNING)
+
+    if args.photos:
+        photos = sorted(os.path.join(args.photos, f) for f in os.listdir(args.photos)
+                        if f.lower().endswith((".jpg", ".jpeg")))
+    else:
+        synthetic_students(folder, args.count, args.resolution)
+        photos = sorted(os.path.join(folder, f) for f in os.listdir(folder)
+                        if f.startswith("photo-"))
+
+    results = dict()
+    for name in args.backends:
+        try:
+            detector = FaceDetector(Config.casc_path, args.detect_max_side,
+                                    args.detect_preset, backends=[name])
+        except ValueError as e:
+            results[name] = {"available": False, "error": str(e)}
+            continue
+        faces = defaultdict(int)
+        start = time.perf_counter()
+        for photo in photos:
+            _, rects, _ = detector.find_faces(photo)
+            faces[min(len(rects), 2)] += 1
+        total = time.perf_counter() - start
+        results[name] = {
+            "available": True,
+            "photos": len(photos),
+            "mean_ms": round(total / len(photos) * 1000, 1),
+            "no_face_rate": round(faces[0] / len(photos), 3),
+            "one_face_rate": round(faces[1] / len(photos), 3),
+            "multi_face_rate": round(faces[2] / len(photos), 3),
+        }
+    return results
+
+
+def bench_scaling(args: argparse.Namespace, folder: os.path) -> dict:
+    """Checks that faces detected on a downscaled image or with a faster
+    preset give the same crops as the full resolution detection with
+    the accurate preset. A photo with one reference face has to give one
+    face with at least --min-iou, that crop is printed without asking.
+    On a photo with several reference faces the user chooses, so every face
+    found has to match one of the reference faces, missing false faces are
+    only counted. Fails with exit code 1 when a combination does not pass."""
+    sys.path.insert(0, REPO_DIR)
+    import logging
+    from config import Config
+    from facedetector import FaceDetector, intersection_over_union
+    logging.disable(logging.WARNING)
+
+    photos = sorted(os.path.join(args.photos, f) for f in os.listdir(args.photos)
+                    if f.lower().endswith((".jpg", ".jpeg")))
+    reference = FaceDetector(Config.casc_path, 0, "accurate")
+    expected = {photo: reference.find_faces(photo)[1] for photo in photos}
+    photos = [photo for photo in photos if len(expected[photo])]
+    if not photos:
+        raise SystemExit(f"No faces found in the photos in '{args.photos}'")
+
+    results = dict()
+    for preset in args.presets:
+        for max_side in args.detect_max_sides:
+            detector = FaceDetector(Config.casc_path, max_side, preset)
+            mismatches = list()
+            ious = list()
+            offsets = list()
+            fewer_faces = 0
+            for photo in photos:
+                _, rects, _ = detector.find_faces(photo)
+                name = os.path.basename(photo)
+                if len(rects) == 0 or (len(expected[photo]) == 1 and len(rects) != 1):
+                    mismatches.append(f"{name}: {len(rects)} faces "
+                                      f"instead of {len(expected[photo])}")
+                    continue
+                fewer_faces += len(rects) < len(expected[photo])
+                for rect in rects:
+                    best = max(expected[photo],
+                               key=lambda r: intersection_over_union(rect, r))
+                    ious.append(intersection_over_union(rect, best))
+                    offsets.append(int(max(abs(int(a) - int(b)) for a, b in zip(rect, best))))
+                    if ious[-1] < args.min_iou:
+                        mismatches.append(f"{name}: face {list(rect)} has IoU {ious[-1]:.3f}")
+            results[f"{preset}_{max_side}"] = {
+                "passed": not mismatches,
+                "photos": len(photos),
+                "min_iou": round(min(ious), 3) if ious else None,
+                "max_offset_px": max(offsets) if offsets else None,
+                "photos_with_fewer_faces": fewer_faces,
+                "mismatches": mismatches,
+            }
+    results["passed"] = all(result["passed"] for result in results.values())
+    return results
+
+
+def bench_download(timer: StageTimer, folder: os.path, photos: list, workers: int) -> None:
+    """Downloads all photos from the local drive server."""
+    from download_images import DownloadImages
+
+    with local_drive(photos) as url:
+        class LocalDownload(DownloadImages):
+            DRIVE_URL = url
+            BATCH_URL = f"{url}/batch/drive/v3"
+
+            def authenticate(self, *args):
+                self.credentials = type("Credentials", (), {"token": "offline", "valid": True})
+
+        os.makedirs(os.path.join(folder, "pictures"), exist_ok=True)
+        with timer("download"):
+            LocalDownload(synthetic_form(folder, photos), workers)
+
+
+def bench_stages(args: argparse.Namespace, folder: os.path) -> dict:
+    """Wall time of every stage of the pipeline, run in a single process."""
+    os.chdir(folder)
+    sys.path.insert(0, REPO_DIR)
+    import logging
+    from config import Config, Renderer, PhotoBlock, TextBlock
+    from canvaslayout import CanvasLayout
+    from facedetector import FaceDetector
+    from generate import Generate, register_fonts
+    from reportlab.lib.units import mm
+    logging.disable(logging.INFO)
+    register_fonts()
+
+    timer = StageTimer()
+    csv_path = synthetic_students(folder, args.count, args.resolution,
+                                  args.unique_photos)
+    photos = sorted({os.path.join(folder, f) for f in os.listdir(folder)
+                     if f.startswith("photo-")})
+    bench_download(timer, folder, photos, args.workers)
+
+    generate = Generate.__new__(Generate)
+    generate.args = argparse.Namespace(renderer=Renderer.TABLE, stream=False,
+                                       workers=1)
+    with timer("load_csv"):
+        students = generate.load_students(csv_path)
+
+    detector = FaceDetector(Config.casc_path, args.detect_max_side,
+                            args.detect_preset)
+    crops = list()
+    faces = 0
+    for student in students:
+        with timer("decode"):
+            pil_img = Image.open(student.img_destination)
+            pil_img.load()
+        with timer("exif_transpose"):
+            pil_img = ImageOps.exif_transpose(pil_img)
+        with timer("grayscale_equalize"):
+            gray, scale, shape = detector.prepare_gray(pil_img)
+        with timer("detect"):
+            rects, _ = detector.detect_faces(gray, scale=scale, shape=shape)
+        faces += len(rects)
+        with timer("crop"):
+            cropped = detector.crop_image(pil_img, rects[0]) if len(rects) else pil_img
+        with timer("encode"):
+            crops.append(detector.save_image(cropped))
+
+    output_path = os.path.join(folder, "output.pdf")
+    pdf_bytes = dict()
+    with timer("layout_text_table"):
+        table_data = generate.generate_text_table(students)
+    with timer("pdf_write_text_table"):
+        generate.build_text_pdf(output_path, table_data)
+    pdf_bytes["text_table"] = os.path.getsize(output_path)
+
+    with timer("layout_photo_table"):
+        table_data = [generate.generate_photo_subtable(student, crop)
+                      for student, crop in zip(students, crops)]
+    with timer("pdf_write_photo_table"):
+        generate.build_photo_pdf(output_path, table_data)
+    pdf_bytes["photo_table"] = os.path.getsize(output_path)
+
+    for crop in crops:
+        crop.seek(0)
+    layouts = {
+        "text": (TextBlock.width * mm, TextBlock.height * mm,
+                 int(210 // TextBlock.width), students, generate.draw_text_block),
+        "photo": ((PhotoBlock.width + 2) * mm, (PhotoBlock.height + 4) * mm,
+                  int(210 // (PhotoBlock.width + 1)), list(zip(students, crops)),
+                  generate.draw_photo_block),
+    }
+    for mode, (col_width, row_height, num_columns, blocks, draw_block) in layouts.items():
+        layout = CanvasLayout(output_path, num_columns, col_width, row_height)
+        with timer(f"layout_{mode}_canvas"):
+            for page in layout.paginate(blocks):
+                layout.draw_page(page, draw_block)
+        with timer(f"pdf_write_{mode}_canvas"):
+            layout.save()
+        pdf_bytes[f"{mode}_canvas"] = os.path.getsize(output_path)
+
+    return {
+        "count": args.count,
+        "resolution": "x".join(map(str, args.resolution)),
+        "detect_max_side": args.detect_max_side,
+        "detect_preset": args.detect_preset,
+        "faces_found": faces,
+        "stages": timer.report(len(students)),
+        "pdf_bytes": pdf_bytes,
+        # ru_maxrss is in kB on Linux
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def bench_pdf(args: argparse.Namespace, folder: os.path) -> dict:
+    """Size and write time of the photo PDF with and without deduplication
+    of repeated photos and page compression, for both renderers. The photos
+    are only resized to the print size, the face detection is skipped."""
+    os.chdir(folder)
+    sys.path.insert(0, REPO_DIR)
+    import logging
+    from io import BytesIO
+    from config import PageConfig, PhotoBlock, Renderer
+    from generate import Generate, register_fonts
+    logging.disable(logging.INFO)
+    register_fonts()
+
+    csv_path = synthetic_students(folder, args.count, args.resolution,
+                                  args.unique_photos)
+    generate = Generate.__new__(Generate)
+    generate.args = argparse.Namespace(renderer=Renderer.CANVAS, stream=False,
+                                       workers=1)
+    students = generate.load_students(csv_path)
+    crops = dict()
+    for student in students:
+        if student.img_destination not in crops:
+            with Image.open(student.img_destination) as img:
+                img.thumbnail((PhotoBlock.width * 12, PhotoBlock.height * 12))
+                crop = BytesIO()
+                img.save(crop, "JPEG", quality=PhotoBlock.jpeg_quality)
+            crops[student.img_destination] = crop.getvalue()
+
+    output_path = os.path.join(folder, "output.pdf")
+    results = dict()
+    # The first one are the reportlab defaults used before
+    settings = {"before": (False, 1, True), "dedupe": (True, 1, True),
+                "dedupe_binary": (True, 1, False),
+                "dedupe_binary_uncompressed": (True, 0, False)}
+    for name, (deduplicate, compression, ascii85) in settings.items():
+        PageConfig.deduplicate_images = deduplicate
+        PageConfig.compression = compression
+        PageConfig.ascii85 = ascii85
+        for renderer in ("table", "canvas"):
+            # Every card gets its own buffer, like the crops from the detector
+            blocks = [(student, BytesIO(crops[student.img_destination]))
+                      for student in students]
+            start = time.perf_counter()
+            if renderer == "table":
+                generate.build_photo_pdf(output_path, [
+                    generate.generate_photo_subtable(student, crop)
+                    for student, crop in blocks])
+            else:
+                generate.photo_layout(output_path).render(
+                    blocks, generate.draw_photo_block)
+            results[f"{renderer}_{name}"] = {
+                "write_s": round(time.perf_counter() - start, 3),
+                "pdf_bytes": os.path.getsize(output_path),
+            }
+
+    return {
+        "count": args.count,
+        "unique_photos": len(crops),
+        "results": results,
+    }
+
+
+def bench_csv(args: argparse.Namespace, folder: os.path) -> dict:
+    """Time of the validation pass and of loading a large students.csv,
+    and the memory taken by the loaded student records."""
+    import tracemalloc
+    os.chdir(folder)
+    sys.path.insert(0, REPO_DIR)
+    from generate import Generate, validate_students
+
+    csv_path = synthetic_students(folder, args.count, (400, 300),
+                                  args.unique_photos)
+    start = time.perf_counter()
+    errors = validate_students(csv_path, check_images=True)
+    validate_s = time.perf_counter() - start
+
+    generate = Generate.__new__(Generate)
+    tracemalloc.start()
+    start = time.perf_counter()
+    students = generate.load_students(csv_path)
+    load_s = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "count": len(students),
+        "errors": len(errors),
+        "validate_s": round(validate_s, 4),
+        "load_s": round(load_s, 4),
+        "bytes_per_student": round(memory / len(students)),
+    }
+
+
+def bench_service(args: argparse.Namespace, folder: os.path) -> dict:
+    """Latency of reprint requests to service.py running in this process,
+    compared with starting generate.py for every reprint. It doubles as
+    an offline end-to-end check, every response has to be a PDF."""
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    os.chdir(folder)
+    sys.path.insert(0, REPO_DIR)
+    import logging
+    logging.disable(logging.INFO)
+
+    csv_path = synthetic_students(folder, args.count, args.resolution)
+    with open(csv_path, "rb") as f:
+        body = f.read()
+
+    sys.argv = ["service.py", "--port", "0", "--service-workers", str(args.concurrency),
+                "--detect-max-side", "640", "--resolve-policy", "largest"]
+    from service import Service, parse_arguments as service_arguments
+    service = Service(service_arguments())
+    server = service.create_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def request(mode: str) -> float:
+        start = time.perf_counter()
+        req = urllib.request.Request(
+            f"http://127.0.0.1:{server.server_port}/{mode}", data=body,
+            headers={"Content-Type": "text/csv"})
+        with urllib.request.urlopen(req) as response:
+            pdf = response.read()
+        if not pdf.startswith(b"%PDF"):
+            raise RuntimeError(f"Service returned no PDF for /{mode}")
+        return time.perf_counter() - start
+
+    results = dict()
+    try:
+        for mode in ("text", "photo"):
+            # The first request fills the crop cache
+            first = request(mode)
+            times = sorted(request(mode) for _ in range(args.requests))
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as executor:
+                list(executor.map(request, [mode] * args.requests))
+            results[f"service_{mode}"] = {
+                "first_s": round(first, 4),
+                "median_s": round(times[len(times) // 2], 4),
+                "concurrent_requests_per_s": round(
+                    args.requests / (time.perf_counter() - start), 1),
+            }
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.pool.shutdown()
+
+    for mode in ("text", "photo"):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, "generate.py"),
+                        "-m", mode, "-p", csv_path, "--detect-max-side", "640",
+                        "--resolve-policy", "largest",
+                        "-o", os.path.join(folder, "output.pdf")],
+                       cwd=folder, input="0\n" * 100, check=True, capture_output=True,
+                       text=True)
+        results[f"process_{mode}_s"] = round(time.perf_counter() - start, 4)
+    return results
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    stages = subparsers.add_parser(
+        "stages", help="Time of every stage of the pipeline",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    stages.add_argument("--count", type=int, default=50,
+                        help="Number of students to generate")
+    stages.add_argument("--resolution", type=parse_resolution,
+                        default=(1600, 1200),
+                        help="Resolution of the synthetic photos")
+    stages.add_argument("--unique-photos", type=int,
+                        help="Reuse photos after this many, default is unique photos")
+    stages.add_argument("--workers", type=int, default=8,
+                        help="Number of concurrent downloads")
+    stages.add_argument("--detect-max-side", type=int, default=0,
+                        help="Longest side of the image used for detection")
+    stages.add_argument("--detect-preset", default="accurate",
+                        help="Speed/accuracy preset of the face detection")
+
+    memory = subparsers.add_parser(
+        "memory", help="Peak memory with and without --stream",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    memory.add_argument("--counts", type=int, nargs="+", default=[50, 500],
+                        help="Numbers of students to generate")
+    memory.add_argument("--resolution", type=parse_resolution,
+                        default=(1600, 1200),
+                        help="Resolution of the synthetic photos")
+    memory.add_argument("--unique-photos", type=int,
+                        help="Reuse photos after this many, default is unique photos")
+    memory.add_argument("--max-growth", type=float, default=10,
+                        help="Allowed growth in MB of the peak memory with --stream "
+                             "from the smallest to the largest count")
+
+    startup = subparsers.add_parser(
+        "startup", help="Time of short runs dominated by imports and setup",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    startup.add_argument("--count", type=int, default=5,
+                         help="Number of students to generate")
+    startup.add_argument("--repeat", type=int, default=10,
+                         help="Number of runs of each command")
+
+    backends = subparsers.add_parser(
+        "backends", help="Speed and multi-face rate of the detection backends",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    backends.add_argument("--backends", nargs="+", default=["haar", "yunet"],
+                          help="Backends to compare")
+    backends.add_argument("--photos",
+                          help="Folder with sample photos, synthetic photos by default")
+    backends.add_argument("--count", type=int, default=50,
+                          help="Number of synthetic photos")
+    backends.add_argument("--resolution", type=parse_resolution,
+                          default=(1600, 1200),
+                          help="Resolution of the synthetic photos")
+    backends.add_argument("--detect-max-side", type=int, default=640,
+                          help="Longest side of the image used for detection")
+    backends.add_argument("--detect-preset", default="accurate",
+                          help="Speed/accuracy preset of the Haar cascade")
+
+    pdf = subparsers.add_parser(
+        "pdf", help="PDF size and write time with and without image deduplication",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    pdf.add_argument("--count", type=int, default=500,
+                     help="Number of students to generate")
+    pdf.add_argument("--unique-photos", type=int, default=100,
+                     help="Reuse photos after this many")
+    pdf.add_argument("--resolution", type=parse_resolution,
+                     default=(1600, 1200),
+                     help="Resolution of the synthetic photos")
+
+    scaling = subparsers.add_parser(
+        "scaling", help="Pass/fail check of downscaled detection and the presets "
+                        "against the full resolution detection",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    scaling.add_argument("--photos", required=True,
+                         help="Folder with sample photos of faces")
+    scaling.add_argument("--detect-max-sides", type=int, nargs="+", default=[0, 1024, 640],
+                         help="Longest sides of the image used for detection, "
+                              "0 is the full resolution")
+    scaling.add_argument("--presets", nargs="+", default=["accurate", "balanced", "fast"],
+                         help="Presets of the Haar cascade to check")
+    scaling.add_argument("--min-iou", type=float, default=0.8,
+                         help="Minimal intersection over union with the reference")
+
+    csv_parser = subparsers.add_parser(
+        "csv", help="Validation and loading of a large students.csv",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    csv_parser.add_argument("--count", type=int, default=10000,
+                            help="Number of students to generate")
+    csv_parser.add_argument("--unique-photos", type=int, default=20,
+                            help="Reuse photos after this many")
+
+    service = subparsers.add_parser(
+        "service", help="Latency of reprints from service.py against new processes",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    service.add_argument("--count", type=int, default=2,
+                         help="Number of students in every request")
+    service.add_argument("--requests", type=int, default=20,
+                         help="Number of requests of each mode")
+    service.add_argument("--concurrency", type=int, default=4,
+                         help="Concurrent requests and workers of the service")
+    service.add_argument("--resolution", type=parse_resolution,
+                         default=(1600, 1200),
+                         help="Resolution of the synthetic photos")
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument("--workdir",
+                               help="Folder for the synthetic data, "
+                                    "a temporary folder by default")
+    return parser.parse_args()
+
+
+BENCHMARKS = {
+    "stages": bench_stages,
+    "memory": bench_memory,
+    "startup": bench_startup,
+    "backends": bench_backends,
+    "scaling": bench_scaling,
+    "pdf": bench_pdf,
+    "csv": bench_csv,
+    "service": bench_service,
+}
+
+
+def main():
+    args = parse_arguments()
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = args.workdir or tmp
+        os.makedirs(folder, exist_ok=True)
+        prepare_workdir(folder)
+        results = BENCHMARKS[args.benchmark](args, folder)
+    print(json.dumps({args.benchmark: results}, indent=2))
+    # Checks like scaling report whether they passed
+    if isinstance(results, dict) and results.get("passed") is False:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "_generate":
+        child_generate(sys.argv[2:])
+    else:
+        main()
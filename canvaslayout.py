@@ -0,0 +1,126 @@
+import os
+
+from typing import Callable, Iterable, Iterator
+from reportlab.lib import colors
+from reportlab.pdfgen.canvas import Canvas
+
+from config import PageConfig
+from pdfimages import pdf_settings
+from pdfparts import concatenate
+
+# Padding of the frame used by SimpleDocTemplate, kept so that both
+# renderers place the cards at the same coordinates
+FRAME_PADDING = 6
+
+
+class CanvasLayout:
+    """Places card blocks in a grid directly on the canvas, page by page.
+    It is an alternative to the Table layout in Generate, which platypus
+    has to measure and split as a whole before anything is written.
+
+    The canvas keeps all pages in memory until it is saved. With chunk_pages
+    every chunk_pages pages are saved as a separate part next to the output
+    and the parts are concatenated by save(), so the memory does not grow
+    with the number of pages."""
+
+    def __init__(self, output_path: os.path, num_columns: int,
+                 col_width: float, row_height: float, chunk_pages: int = 0) -> None:
+        self.output_path = output_path
+        self.chunk_pages = chunk_pages
+        self.part_paths = list()
+        self.pages_in_canvas = 0
+        self.canvas = self.create_canvas()
+        self.num_columns = num_columns
+        self.col_width = col_width
+        self.row_height = row_height
+
+        page_width, page_height = PageConfig.page_size
+        frame_width = (page_width - PageConfig.margin_left
+                       - PageConfig.margin_right - 2 * FRAME_PADDING)
+        frame_height = (page_height - PageConfig.margin_top
+                        - PageConfig.margin_bottom - 2 * FRAME_PADDING)
+
+        # The grid is centered horizontally and aligned to the top of the frame
+        self.left = (PageConfig.margin_left + FRAME_PADDING
+                     + (frame_width - num_columns * col_width) / 2)
+        self.top = page_height - PageConfig.margin_top - FRAME_PADDING
+        self.num_rows = max(1, int(frame_height // row_height))
+
+    def create_canvas(self) -> Canvas:
+        output_path = self.output_path
+        if self.chunk_pages:
+            output_path = f"{self.output_path}.part-{len(self.part_paths)}"
+            self.part_paths.append(output_path)
+        return Canvas(output_path, pagesize=PageConfig.page_size,
+                      pageCompression=PageConfig.compression)
+
+    @property
+    def page_size(self) -> int:
+        """Number of cards that fit on a single page."""
+        return self.num_rows * self.num_columns
+
+    def cell_origin(self, slot: int) -> tuple:
+        """Bottom left corner of the cell at the given position on the page."""
+        row, col = divmod(slot, self.num_columns)
+        x = self.left + col * self.col_width
+        y = self.top - (row + 1) * self.row_height
+        return x, y
+
+    def draw_grid(self, rows: int) -> None:
+        width = self.num_columns * self.col_width
+        bottom = self.top - rows * self.row_height
+        self.canvas.setStrokeColor(colors.black)
+        self.canvas.setLineWidth(0.5)
+        for row in range(rows + 1):
+            y = self.top - row * self.row_height
+            self.canvas.line(self.left, y, self.left + width, y)
+        for col in range(self.num_columns + 1):
+            x = self.left + col * self.col_width
+            self.canvas.line(x, self.top, x, bottom)
+
+    def draw_page(self, blocks: list, draw_block: Callable) -> None:
+        """Draws one page of blocks, draw_block is called with
+        the canvas, the origin of the cell and the block."""
+        with pdf_settings():
+            rows = -(-len(blocks) // self.num_columns)
+            self.draw_grid(rows)
+            for slot, block in enumerate(blocks):
+                x, y = self.cell_origin(slot)
+                draw_block(self.canvas, x, y, block)
+            self.canvas.showPage()
+            self.pages_in_canvas += 1
+            if self.chunk_pages and self.pages_in_canvas == self.chunk_pages:
+                self.canvas.save()
+                self.canvas = self.create_canvas()
+                self.pages_in_canvas = 0
+
+    def paginate(self, blocks: Iterable) -> Iterator[list]:
+        """Splits the blocks into pages, the input is consumed lazily."""
+        page = list()
+        for block in blocks:
+            page.append(block)
+            if len(page) == self.page_size:
+                yield page
+                page = list()
+        if page:
+            yield page
+
+    def save(self) -> None:
+        with pdf_settings():
+            if not self.chunk_pages:
+                self.canvas.save()
+                return
+            if self.pages_in_canvas or len(self.part_paths) == 1:
+                self.canvas.save()
+            else:
+                # The last part would be an empty page
+                self.part_paths.pop()
+            concatenate(self.part_paths, self.output_path)
+            for part_path in self.part_paths:
+                os.remove(part_path)
+
+    def render(self, blocks: Iterable, draw_block: Callable) -> None:
+        """Draws all blocks, starting a new page whenever the current one is full."""
+        for page in self.paginate(blocks):
+            self.draw_page(page, draw_block)
+        self.save()
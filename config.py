@@ -7,9 +7,73 @@ from reportlab.lib.pagesizes import A4
 class Config:
     section: str = "ESN VUT Brno"
     university: str = "VUT Brno"
+    # Format of the dates printed on the cards and stored in students.csv
+    card_date_format: str = "%d  %m  %y"
     imgpath: os.path = os.path.join(os.getcwd(), "pictures")
     student_csv_path: os.path = os.path.join(os.getcwd(), "students.csv")
     casc_path: os.path = "./haarcascade_frontalface_default.xml"
+    download_workers: int = 8
+    # Progress of download runs, used to resume an interrupted run
+    download_manifest_path: os.path = os.path.join(os.getcwd(), "pictures", "manifest.jsonl")
+    workers: int = os.cpu_count() or 1
+    # Number of students waiting between two stages of pipeline.py
+    pipeline_queue_size: int = 64
+    # Folder with form exports or a single export watched by watch.py
+    watch_path: os.path = os.path.join(os.getcwd(), "input")
+    watch_interval: int = 30  # in seconds
+    # Rows already processed by watch.py and students waiting for a full sheet
+    watch_state_path: os.path = os.path.join(os.getcwd(), "output", "watch-state.json")
+    cache_path: os.path = os.path.join(os.getcwd(), "cache")
+    cache_max_size: int = 500 * 1024 * 1024  # in bytes
+    decisions_path: os.path = os.path.join(os.getcwd(), "decisions.sqlite3")
+    # Decisions from older versions, imported into decisions_path on first run
+    legacy_decisions_path: os.path = os.path.join(os.getcwd(), "decisions.pickle")
+    # Thumbnails of queued photos shown by review.py
+    review_path: os.path = os.path.join(os.getcwd(), "review")
+    review_port: int = 8000
+    # Local HTTP service rendering cards on demand, see service.py
+    service_host: str = "127.0.0.1"
+    service_port: int = 8080
+    service_workers: int = 4
+    service_max_body: int = 16 * 1024 * 1024  # in bytes
+    # Pages and slots of students in the last output, for incremental rebuilds
+    manifest_path: os.path = os.path.join(os.getcwd(), "output", "{mode}-manifest.json")
+
+
+class DetectorConfig:
+    """Settings for face detection"""
+    # Longest side in px of the image used for detection, 0 keeps full resolution
+    max_side = 0
+    # Presets of the cascade (scaleFactor, minNeighbors), lower scaleFactor
+    # is slower but more accurate. Fewer image scales give fewer neighbours.
+    # `benchmark.py scaling` checks them against the full resolution accurate preset.
+    preset = "accurate"
+    presets = {
+        "accurate": (1.01, 50),
+        "balanced": (1.03, 17),
+        "fast": (1.1, 5),
+    }
+    # Minimal face size in px of the full resolution image
+    min_size = 100
+    # Backends tried in order, the next one is used when a backend
+    # does not find any face. All of them have to be available.
+    backends = ["haar"]
+    # Model of the YuNet backend from the OpenCV model zoo
+    yunet_model = "./face_detection_yunet_2023mar.onnx"
+    yunet_score_threshold = 0.8
+    # Automatic choice between multiple faces: manual (ask the user), largest,
+    # central, confidence or agreement with the other backends of the chain
+    resolve_policies = ["manual", "largest", "central", "confidence", "agreement"]
+    resolve_policy = "manual"
+    # How many times larger, closer to the centre or more confident
+    # the chosen face has to be than the next one
+    resolve_margin = 1.5
+    # Minimal intersection over union of faces found by two backends
+    agreement_iou = 0.3
+    # Queue photos that are still ambiguous for review.py instead of asking
+    queue_review = False
+    # Decode JPEGs only in the resolution needed for detection and printing
+    fast_decode = False
 
 
 class PageConfig:
@@ -19,6 +83,17 @@ class PageConfig:
     margin_right = 10
     margin_top = 10
     margin_bottom = 10
+    # Flate compression of the page contents, reportlab enables it by default
+    # but rl_config can turn it off for the whole process
+    compression = 1
+    # Embed every distinct photo only once, repeated photos reference it
+    deduplicate_images = True
+    # reportlab encodes binary streams as ASCII85 by default, which makes
+    # the embedded photos a quarter larger
+    ascii85 = False
+    # Pages kept in memory by --stream, the output is written in parts
+    # of this many pages which are concatenated at the end
+    stream_chunk_pages = 1
 
 
 class PhotoBlock:
@@ -27,6 +102,11 @@ class PhotoBlock:
     height = 35
     font_size = 1.5
     font = "Lato"
+    # Resolution of the embedded photos, 0 keeps the original size
+    dpi = 300
+    jpeg_quality = 90
+    jpeg_optimize = False
+    jpeg_progressive = False
 
 
 class TextBlock:
@@ -57,3 +137,14 @@ class PrintMode(Enum):
 
     def __repr__(self):
         return self.value
+
+
+class Renderer(Enum):
+    TABLE = 'table'    # Platypus table of nested tables for each card
+    CANVAS = 'canvas'  # Cards drawn directly on the canvas page by page
+
+    def __str__(self):
+        return self.value
+
+    def __repr__(self):
+        return self.value
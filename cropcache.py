@@ -0,0 +1,89 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+from io import BytesIO
+
+from config import Config
+from profiler import profiler
+
+log = logging.getLogger(__name__)
+
+
+class CropCache:
+    """On-disk cache of cropped photos. Entries are keyed by the hash
+    of the source image and of all parameters that affect the crop,
+    so a changed photo or setting never returns a stale crop."""
+
+    def __init__(self, path: os.path = Config.cache_path,
+                 max_size: int = Config.cache_max_size) -> None:
+        self.path = path
+        self.max_size = max_size
+
+    def key(self, img_hash: str, params: tuple) -> str:
+        digest = hashlib.sha256(img_hash.encode())
+        digest.update(repr(params).encode())
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> os.path:
+        return os.path.join(self.path, f"{key}.jpg")
+
+    def get(self, key: str) -> BytesIO:
+        """Returns the cached crop or None when it is not in the cache."""
+        entry = self.entry_path(key)
+        try:
+            with open(entry, "rb") as f:
+                buf = BytesIO(f.read())
+        except FileNotFoundError:
+            profiler.count("cache_miss")
+            return None
+
+        # Mark the entry as recently used for the eviction
+        os.utime(entry)
+        profiler.count("cache_hit")
+        return buf
+
+    def put(self, key: str, buf: BytesIO) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        # Write to a temporary file first, so other workers
+        # never read a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(buf.getvalue())
+        os.replace(tmp_path, self.entry_path(key))
+
+    def entries(self) -> list:
+        if not os.path.isdir(self.path):
+            return []
+        return [entry for entry in os.scandir(self.path)
+                if entry.is_file() and entry.name.endswith(".jpg")]
+
+    def evict(self) -> None:
+        """Removes least recently used entries until the cache fits max_size."""
+        # Other threads of service.py may evict the same entries concurrently
+        entries = list()
+        for entry in self.entries():
+            try:
+                entries.append((entry.path, entry.stat()))
+            except FileNotFoundError:
+                continue
+        entries.sort(key=lambda e: e[1].st_mtime)
+        total = sum(stat.st_size for _, stat in entries)
+        removed = 0
+        while entries and total > self.max_size:
+            path, stat = entries.pop(0)
+            total -= stat.st_size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+        if removed:
+            log.info(f"Evicted {removed} photos from the crop cache")
+
+    def clear(self) -> None:
+        entries = self.entries()
+        for entry in entries:
+            os.remove(entry.path)
+        log.info(f"Removed {len(entries)} photos from the crop cache")
@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+
+from typing import List
+
+from config import Config
+from tools import file_hash
+
+log = logging.getLogger(__name__)
+
+
+class DecisionStore:
+    """Faces chosen by the user in photos with multiple detections.
+    The chosen rectangle is stored under the hash of the image contents,
+    so decisions survive moving the pictures and changing detector settings.
+    Photos waiting for a decision can be queued for a batched review.
+    The database is opened on first use, once per process."""
+
+    def __init__(self, path: os.path = Config.decisions_path) -> None:
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # Worker processes open their own connection
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["path"])
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   check_same_thread=False)
+            # WAL lets the workers read while another process writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS decisions (
+                                hash TEXT PRIMARY KEY,
+                                x0 INTEGER, y0 INTEGER, x1 INTEGER, y1 INTEGER)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS queue (
+                                hash TEXT PRIMARY KEY,
+                                path TEXT,
+                                rects TEXT)""")
+            self._conn = conn
+        return self._conn
+
+    def get(self, img_hash: str) -> List[int]:
+        """Returns the chosen rectangle or None if there is no decision."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT x0, y0, x1, y1 FROM decisions WHERE hash = ?",
+                (img_hash,)).fetchone()
+        return list(row) if row is not None else None
+
+    def put(self, img_hash: str, rect: List[int]) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?, ?)",
+                (img_hash, *(int(c) for c in rect)))
+            self.conn.execute("DELETE FROM queue WHERE hash = ?", (img_hash,))
+
+    def enqueue(self, img_hash: str, img_path: os.path, rects: List[List[int]]) -> None:
+        """Queues the photo and its detected faces for the review."""
+        rects = [[int(c) for c in rect] for rect in rects]
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO queue VALUES (?, ?, ?)",
+                (img_hash, img_path, json.dumps(rects)))
+
+    def queued(self) -> List[tuple]:
+        """Photos waiting for the review as (hash, path, rects)."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT hash, path, rects FROM queue ORDER BY path").fetchall()
+        return [(img_hash, path, json.loads(rects)) for img_hash, path, rects in rows]
+
+    def import_pickle(self, pickle_path: os.path, detector) -> int:
+        """Imports decisions from the old decisions.pickle, which stored
+        the index of the chosen face by the image path. The faces are detected
+        again with the given detector to turn the index into a rectangle,
+        so it has to use the settings the pickle was created with."""
+        with open(pickle_path, "rb") as f:
+            prev_decisions = pickle.load(f)
+
+        imported = 0
+        for img_path, selected in prev_decisions.items():
+            if not os.path.exists(img_path):
+                log.warning(f"Skipping decision for missing image '{img_path}'")
+                continue
+            img_hash = file_hash(img_path)
+            if self.get(img_hash) is not None:
+                continue
+            _, rects, _ = detector.find_faces(img_path)
+            if selected >= len(rects):
+                log.warning(f"Skipping decision for '{img_path}', "
+                            f"face number {selected} was not detected")
+                continue
+            self.put(img_hash, rects[selected])
+            imported += 1
+
+        log.info(f"Imported {imported} decisions from '{pickle_path}'")
+        return imported
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,144 @@
+import cv2
+import logging
+import os
+import threading
+import numpy as np
+
+from typing import Callable, List, Tuple
+
+from config import DetectorConfig
+
+log = logging.getLogger(__name__)
+
+# Detectors are cached per thread, because neither a CascadeClassifier nor
+# a FaceDetectorYN instance is safe to use from several threads at once.
+# Worker processes get their own copy of the module, so each process
+# loads a model only once.
+_models = threading.local()
+
+
+def get_model(key: tuple, load: Callable):
+    """Returns the model for the given key, it is loaded
+    on first use and then reused for the rest of the process."""
+    registry = getattr(_models, "registry", None)
+    if registry is None:
+        registry = _models.registry = dict()
+    if key not in registry:
+        registry[key] = load()
+        log.debug(f"Loaded face detection model {key}")
+    return registry[key]
+
+
+def get_cascade(casc_path: os.path) -> cv2.CascadeClassifier:
+    key = os.path.abspath(casc_path)
+
+    def load():
+        cascade = cv2.CascadeClassifier(key)
+        if cascade.empty():
+            raise ValueError(f"Could not load face cascade from '{casc_path}'")
+        return cascade
+    return get_model(("haar", key), load)
+
+
+class HaarBackend:
+    """Haar cascade of OpenCV, the default backend. The number of
+    neighbouring detections merged into a face is used as its score."""
+
+    name = "haar"
+
+    def __init__(self, casc_path: os.path, preset: str) -> None:
+        self.casc_path = casc_path
+        self.scale_factor, self.min_neighbors = DetectorConfig.presets[preset]
+
+    def available(self) -> bool:
+        return os.path.exists(self.casc_path)
+
+    def missing(self) -> str:
+        return f"the cascade '{self.casc_path}' does not exist"
+
+    def params(self) -> tuple:
+        return (self.name, os.path.basename(self.casc_path),
+                self.scale_factor, self.min_neighbors)
+
+    def detect(self, gray: np.ndarray, min_size: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns squares (x, y, w, h) around the faces and their scores."""
+        rects, neighbours = get_cascade(self.casc_path).detectMultiScale2(
+            gray,
+            scaleFactor=self.scale_factor,
+            minNeighbors=self.min_neighbors,
+            minSize=(min_size, min_size),
+            flags=cv2.CASCADE_SCALE_IMAGE
+        )
+        return (np.array(rects, dtype=int).reshape(-1, 4),
+                np.array(neighbours, dtype=float).reshape(-1))
+
+
+class YuNetBackend:
+    """YuNet face detection network of the OpenCV DNN module. It runs on the
+    CPU without network access, but needs the ONNX model from the OpenCV model
+    zoo, see README. Faster than the cascade on downscaled images and it
+    returns far fewer false faces. The score is the network confidence."""
+
+    name = "yunet"
+
+    def __init__(self, model_path: os.path = DetectorConfig.yunet_model,
+                 score_threshold: float = DetectorConfig.yunet_score_threshold) -> None:
+        self.model_path = model_path
+        self.score_threshold = score_threshold
+
+    def available(self) -> bool:
+        return hasattr(cv2, "FaceDetectorYN") and os.path.exists(self.model_path)
+
+    def missing(self) -> str:
+        if not hasattr(cv2, "FaceDetectorYN"):
+            return "it needs OpenCV 4.5.4 or newer"
+        return (f"download face_detection_yunet_2023mar.onnx from the OpenCV model zoo "
+                f"to '{self.model_path}', see README")
+
+    def params(self) -> tuple:
+        return (self.name, os.path.basename(self.model_path), self.score_threshold)
+
+    def detect(self, gray: np.ndarray, min_size: int) -> Tuple[np.ndarray, np.ndarray]:
+        height, width = gray.shape
+        net = get_model(
+            ("yunet", os.path.abspath(self.model_path), self.score_threshold),
+            lambda: cv2.FaceDetectorYN.create(self.model_path, "", (width, height),
+                                              self.score_threshold))
+        net.setInputSize((width, height))
+        # The network takes a colour image, all backends share the grayscale one
+        _, faces = net.detect(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR))
+        if faces is None:
+            return np.empty((0, 4), dtype=int), np.empty(0)
+
+        # Rows are x, y, w, h, 5 landmarks and the score. The boxes are
+        # made square around their centre, like the ones of the cascade.
+        side = np.maximum(faces[:, 2], faces[:, 3])
+        keep = side >= min_size
+        faces, side = faces[keep], side[keep]
+        x = faces[:, 0] + (faces[:, 2] - side) / 2
+        y = faces[:, 1] + (faces[:, 3] - side) / 2
+        rects = np.round(np.stack([x, y, side, side], axis=1)).astype(int)
+        return rects, faces[:, -1].astype(float)
+
+
+# Factories of the backends taking the cascade path and the preset
+BACKENDS = {
+    HaarBackend.name: lambda casc_path, preset: HaarBackend(casc_path, preset),
+    YuNetBackend.name: lambda casc_path, preset: YuNetBackend(),
+}
+
+
+def create_backends(names: List[str], casc_path: os.path, preset: str) -> list:
+    """Creates the fallback chain of backends. A backend that was asked for
+    but is not available is an error, falling back to the next one
+    would silently run a different detection."""
+    chain = list()
+    for name in names:
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown detection backend '{name}'")
+        backend = BACKENDS[name](casc_path, preset)
+        if not backend.available():
+            raise ValueError(f"Face detection backend '{name}' is not available, "
+                             f"{backend.missing()}")
+        chain.append(backend)
+    return chain
@@ -1,29 +1,59 @@
+import argparse
 import csv
+import hashlib
+import json
 import logging
 import os
 import pickle
 import requests
-import sys
+import threading
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
-from PIL import Image
-from pillow_heif import register_heif_opener
+from email.parser import BytesParser
+from typing import TYPE_CHECKING
+from requests.adapters import HTTPAdapter
 
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+from config import Config
+from downloadmanifest import DownloadManifest
+from tools import file_hash
+from profiler import profiler, report as profile_report
+
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
 
 log = logging.getLogger()
 logging.basicConfig(level=logging.INFO)
 
-register_heif_opener()
+
+def convert_to_jpeg(source_path: str, destination: str) -> None:
+    """Converts a downloaded photo to JPEG and removes the source.
+    PIL is imported here, in the converter processes only."""
+    from PIL import Image
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+
+    tmp_path = f"{destination}.part"
+    with Image.open(source_path) as img:
+        img.convert("RGB").save(tmp_path, "JPEG")
+    os.replace(tmp_path, destination)
+    os.remove(source_path)
 
 
 class DownloadImages:
 
-    credentials: Credentials
-    csv_output: list = list()
+    credentials: "Credentials" = None
+    session: requests.Session
+    csv_output: list
+    failed: list
+
+    # Base URL of the Drive API, can be pointed to a local server for testing
+    DRIVE_URL = "https://www.googleapis.com/drive/v3"
+    BATCH_URL = "https://www.googleapis.com/batch/drive/v3"
+    # Drive accepts at most 100 calls in a single batch request
+    BATCH_SIZE = 100
+    # Size in bytes of the chunks written to disk while downloading
+    CHUNK_SIZE = 1 << 20
 
     # Select the column where the data is
     # A->0, B->1, C->2, D->3, E->4,
@@ -33,12 +63,70 @@ class DownloadImages:
     DATEOFBIRTH_IDX = 3
     PHOTOURL_IDX = 4
 
-    def __init__(self, csv_file):
-        self.authenticate()
-        self.parse_input_csv(csv_file)
-        self.save_csv_output()
+    def __init__(self, csv_file, workers: int = Config.download_workers,
+                 resume: bool = False, validate: bool = False):
+        self.setup(workers, resume, validate)
+        # Conversion of non-JPEG photos is CPU bound, processes are started
+        # only when the first such photo is downloaded
+        with ProcessPoolExecutor(max_workers=Config.workers) as self.converter:
+            self.parse_input_csv(csv_file)
+        if self.manifest is None:
+            self.save_csv_output()
+        self.report_failures()
+
+    def setup(self, workers: int, resume: bool, validate: bool):
+        """Prepares the session, used by long running
+        subclasses that download several batches of rows."""
+        self.workers = max(1, workers)
+        # With resume the progress is kept in the manifest and
+        # students.csv is written row by row instead of at the end.
+        # Validation compares checksums from Drive with the manifest.
+        self.manifest = DownloadManifest() if resume or validate else None
+        self.validate = validate
+        self.metadata = dict()
+        self.csv_output = list()
+        self.failed = list()
+        self._auth_lock = threading.Lock()
+        self.session = self.create_session()
+
+    def create_session(self) -> requests.Session:
+        """Creates a session shared by all download threads, so the
+        keep-alive connections to Drive are reused between files."""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def access_token(self) -> str:
+        """Authenticates before the first request, the Google auth libraries
+        are not even imported when all pictures are already downloaded.
+        The token expires after about an hour, long running modes like
+        watch.py and pipeline.py refresh it here."""
+        with self._auth_lock:
+            if self.credentials is None:
+                self.authenticate()
+            elif not self.credentials.valid:
+                self.refresh_credentials()
+            return self.credentials.token
+
+    def refresh_credentials(self, token_path: str = "token.pickle"):
+        from google.auth.transport.requests import Request
+
+        if not self.credentials.refresh_token:
+            log.info("The access token expired, logging in again")
+            self.credentials = None
+            self.authenticate(token_path)
+            return
+        log.info("Refreshing the expired access token")
+        self.credentials.refresh(Request())
+        with open(token_path, 'wb') as token:
+            pickle.dump(self.credentials, token)
 
     def authenticate(self, token_path: str = "token.pickle", client_secret_path: str = "client_secret.json"):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from google.auth.transport.requests import Request
+
         SCOPES = [
             'https://www.googleapis.com/auth/drive.file',
             'https://www.googleapis.com/auth/drive',
@@ -66,23 +154,83 @@ class DownloadImages:
 
         self.credentials = credentials
 
-    def download_file(self, file_id: str, destination: str):
-        response = requests.get(
-            "https://www.googleapis.com/drive/v3/files/{}?alt=media".format(
-                file_id),
-            params={'id': id},
-            stream=True,
-            headers={'Authorization': 'Bearer {}'.format(
-                self.credentials.token)},
-            timeout=10
+    def batch_metadata(self, file_ids: list) -> dict:
+        """Fetches md5 checksums of up to BATCH_SIZE files in a single
+        multipart/mixed batch request to Drive."""
+        boundary = "batch_metadata"
+        parts = list()
+        for idx, file_id in enumerate(file_ids):
+            parts.append(f"--{boundary}\r\n"
+                         f"Content-Type: application/http\r\n"
+                         f"Content-ID: <item{idx}>\r\n\r\n"
+                         f"GET /drive/v3/files/{file_id}?fields=id,md5Checksum,mimeType,size\r\n\r\n")
+        parts.append(f"--{boundary}--\r\n")
+
+        response = self.session.post(
+            self.BATCH_URL,
+            data="".join(parts).encode(),
+            headers={'Authorization': 'Bearer {}'.format(self.access_token()),
+                     'Content-Type': f'multipart/mixed; boundary={boundary}'},
+            timeout=30
         )
+        response.raise_for_status()
+
+        # The response is a multipart message with a HTTP response in each part
+        message = BytesParser().parsebytes(
+            f"Content-Type: {response.headers['Content-Type']}\r\n\r\n".encode()
+            + response.content)
+        metadata = dict()
+        for part in message.get_payload():
+            http_response = part.get_payload(decode=True)
+            status_line, _, rest = http_response.partition(b"\r\n")
+            if b" 200 " not in status_line + b" ":
+                continue
+            body = rest.split(b"\r\n\r\n", 1)[-1]
+            try:
+                item = json.loads(body)
+            except ValueError:
+                continue
+            metadata[item["id"]] = item
+        return metadata
+
+    def fetch_metadata(self, file_ids: list) -> dict:
+        """Metadata of all files, requested in batches. Files whose metadata
+        could not be fetched are missing from the result."""
+        metadata = dict()
+        for start in range(0, len(file_ids), self.BATCH_SIZE):
+            chunk = file_ids[start:start + self.BATCH_SIZE]
+            try:
+                with profiler.stage("metadata"):
+                    metadata.update(self.batch_metadata(chunk))
+            except (requests.RequestException, KeyError) as e:
+                log.warning(f"Fetching metadata of {len(chunk)} files failed, "
+                            f"falling back to the manifest ({e})")
+        log.info(f"Fetched metadata of {len(metadata)} files")
+        return metadata
+
+    def download_file(self, file_id: str, destination: str) -> str:
+        """Downloads a single file from drive. Returns md5 of the downloaded file,
+        same as md5Checksum in Drive, or None when the picture could not be saved.
+        Errors are only logged so the batch can continue."""
+        try:
+            response = self.session.get(
+                "{}/files/{}?alt=media".format(self.DRIVE_URL, file_id),
+                stream=True,
+                headers={'Authorization': 'Bearer {}'.format(
+                    self.access_token())},
+                timeout=10
+            )
+        except requests.RequestException as e:
+            log.error(
+                f"Downloading file ID {file_id} failed! The picture wont be saved! ({e})")
+            return None
 
         # Handle problems with download
         if response.status_code != 200:
             log.error(
                 f"Downloading file ID {file_id} failed! The picture wont be saved!")
             log.error(response.text)
-            return
+            return None
 
         if "image" not in response.headers["Content-Type"]:
             log.info(response.headers["Content-Type"])
@@ -95,17 +243,37 @@ class DownloadImages:
         # This conversion is needed in case users upload HEIF or other format photos.
         # The face detector can only take JPEG files
         datatype = response.headers.get("Content-Type")
-        if datatype == "image/jpeg":
-            with open(destination, "wb") as f:
-                f.write(response.content)
-        else:
-            log.warning(
-                f"The user is using weird photo format [{datatype}]. Attempting covnersion.")
-            buf = BytesIO(response.content)
-            img = Image.open(buf)
-            img.convert("RGB").save(destination, "JPEG")
+        # Written under a temporary name first, so an interrupted
+        # download never leaves a truncated picture behind
+        tmp_path = f"{destination}.part"
+        source_path = tmp_path if datatype == "image/jpeg" else f"{destination}.source"
+        md5 = hashlib.md5()
+        try:
+            # Streamed to disk in chunks, large uploads are never held in memory
+            with open(source_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                    md5.update(chunk)
+                    f.write(chunk)
+            if datatype == "image/jpeg":
+                os.replace(tmp_path, destination)
+            else:
+                log.warning(
+                    f"The user is using weird photo format [{datatype}]. Attempting covnersion.")
+                # Runs in the converter processes, this thread only waits
+                # while the other threads keep downloading
+                with profiler.stage("convert", destination):
+                    self.converter.submit(convert_to_jpeg, source_path, destination).result()
+        except Exception as e:
+            # Besides OSError, decoding in the converter raises e.g. PIL's
+            # DecompressionBombError, only this picture fails
+            log.error(f"Saving file ID {file_id} to '{destination}' failed! ({e!r})")
+            for path in (tmp_path, source_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return None
 
         log.debug(f"Saved {destination}")
+        return md5.hexdigest()
 
     def get_file_id(self, file_url: str) -> str:
         # Example https://drive.google.com/open?id=1REKpuL5TUKwNvupg9_f5EzAIrcFPGt
@@ -115,44 +283,182 @@ class DownloadImages:
     def parse_date_of_birth(self, raw_date: str) -> datetime:
         try:
             dt = datetime.strptime(raw_date, "%m/%d/%Y").date()
-            return dt.strftime("%d  %m  %y")
+            return dt.strftime(Config.card_date_format)
         except ValueError:
             log.error(
                 f"Value '{raw_date}' does not match the mm/dd/yyyy date format!")
-            exit()
+            raise
 
-    def save_csv_output(self, filename: str = "students.csv"):
-        with open(filename, "w+") as f:
+    def save_csv_output(self, filename: str = "students.csv", rows: list = None):
+        rows = self.csv_output if rows is None else rows
+        tmp_path = f"{filename}.tmp"
+        with open(tmp_path, "w") as f:
             csv_writer = csv.writer(f)
-            for row in self.csv_output:
+            for row in rows:
                 csv_writer.writerow(row)
+        os.replace(tmp_path, filename)
 
-    def process_line(self, line: str):
+    def process_line(self, line: str) -> tuple:
+        """Parses one row of the form export into the students.csv format."""
         name = line[self.NAME_IDX].strip()
         date_of_birth = self.parse_date_of_birth(line[self.DATEOFBIRTH_IDX])
         nationality = line[self.NATIONALITY_IDX].strip().capitalize()
         file_id = self.get_file_id(line[self.PHOTOURL_IDX])
-        today = datetime.now().strftime("%d  %m  %y")
-
-        log.info(f"Processing: {name}")
+        today = datetime.now().strftime(Config.card_date_format)
 
         img_destination = os.path.join(os.getcwd(), "pictures", f"{name}.jpg")
-        if not os.path.exists(img_destination):
-            self.download_file(file_id, img_destination)
+        return [name, date_of_birth, nationality, today, img_destination], file_id
+
+    def is_downloaded(self, img_destination: str, file_id: str) -> bool:
+        if self.manifest is None:
+            return os.path.exists(img_destination)
+        md5 = self.metadata.get(file_id, {}).get("md5Checksum")
+        if md5 is None:
+            return self.manifest.is_done(img_destination, file_id)
 
-        self.csv_output.append(
-            [name, date_of_birth, nationality, today, img_destination])
+        if self.manifest.is_current(img_destination, md5):
+            profiler.count("not_modified")
+            return True
+        # Pictures downloaded without checksum are adopted when they are the
+        # same file, converted ones have a different checksum and are downloaded
+        if (self.manifest.entries.get(img_destination, {}).get("md5") is None
+                and os.path.exists(img_destination)
+                and file_hash(img_destination, algorithm="md5") == md5):
+            self.manifest.record(img_destination, file_id, DownloadManifest.DONE, md5)
+            profiler.count("not_modified")
+            return True
+        return False
+
+    def download_row(self, row: list, file_id: str) -> tuple:
+        """Downloads the picture of a single student unless it already exists.
+        Returns the row and whether the picture is there. Any error only
+        fails this row, the other rows of the batch continue."""
+        name, img_destination = row[0], row[4]
+        log.info(f"Processing: {name}")
+        try:
+            if self.is_downloaded(img_destination, file_id):
+                return row, True
+            with profiler.stage("download", img_destination):
+                md5 = self.download_file(file_id, img_destination)
+        except Exception:
+            log.exception(f"Downloading the picture of {name} failed")
+            md5 = None
+        if not md5:
+            self.failed.append((name, f"file ID {file_id}"))
+        if self.manifest is not None:
+            status = DownloadManifest.DONE if md5 else DownloadManifest.FAILED
+            self.manifest.record(img_destination, file_id, status, md5 or None)
+        return row, bool(md5)
 
     def parse_input_csv(self, csv_path):
         """Opens the file exported from google sheets, processes the input data
-        and downloads all images from drive and aves them to folder for generation."""
+        and downloads all images from drive and aves them to folder for generation.
+        The downloads run in a thread pool, students.csv keeps the input order."""
         with open(csv_path, "r") as f:
             csv_reader = csv.reader(f)
             next(csv_reader)
+            jobs = list()
             for line in csv_reader:
                 log.debug(f"Processing {line}")
-                self.process_line(line)
+                try:
+                    jobs.append(self.process_line(line))
+                except (ValueError, IndexError):
+                    # Reported with the failed downloads, the other rows continue
+                    log.error(f"Skipping row {line}, fix it in the form and export it again")
+                    name = line[self.NAME_IDX] if len(line) > self.NAME_IDX else str(line)
+                    self.failed.append((name, "invalid row"))
+        self.download_jobs(jobs, csv_path)
+
+    def download_jobs(self, jobs: list, export_path: str = None):
+        """Downloads pictures of the parsed rows and writes them to students.csv.
+        With the manifest, students.csv belongs to the export it was written
+        from: it is appended to while the rows finish, started again for
+        a different export and rewritten from the rows of the export at the end,
+        so students who left the export or changed their details are not kept.
+        Without an export, as in watch.py, students.csv is not written."""
+        if self.validate:
+            self.metadata = self.fetch_metadata(list({file_id for _, file_id in jobs}))
+        if (self.manifest is not None and export_path is not None
+                and not self.manifest.start_export(export_path)
+                and os.path.exists("students.csv")):
+            log.info(f"Starting students.csv again for the export '{export_path}'")
+            os.remove("students.csv")
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # The rows are consumed in the input order, download_row
+            # handles the errors of a single row
+            rows = (self.row_finished(row, downloaded) for row, downloaded
+                    in executor.map(lambda job: self.download_row(*job), jobs))
+            if self.manifest is None:
+                list(rows)
+                self.csv_output.extend(row for row, _ in jobs)
+            elif export_path is None:
+                list(rows)
+            else:
+                self.append_csv_output(rows)
+                self.save_csv_output(rows=[row for row, _ in jobs])
+
+    def row_finished(self, row: list, downloaded: bool) -> list:
+        """Called in the input order as soon as the row and all the rows
+        before it are processed, lets subclasses start working on the row.
+        downloaded is False when the picture could not be downloaded."""
+        return row
+
+    def append_csv_output(self, rows, filename: str = "students.csv"):
+        """Appends rows to students.csv as soon as they are processed, in the
+        input order. Rows already written by an interrupted run of the same
+        export are skipped, they are matched by the picture path as the date
+        of issue may differ."""
+        written = set()
+        if os.path.exists(filename):
+            with open(filename, "r") as f:
+                written = {row[4] for row in csv.reader(f) if len(row) > 4}
+        with open(filename, "a") as f:
+            csv_writer = csv.writer(f)
+            for row in rows:
+                if row[4] in written:
+                    continue
+                csv_writer.writerow(row)
+                f.flush()
+
+    def report_failures(self):
+        if not self.failed:
+            return
+        log.error(f"{len(self.failed)} students failed:")
+        for name, reason in self.failed:
+            log.error(f"  {name} ({reason})")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('csv_file',
+                        help='CSV file exported from the application form.')
+    parser.add_argument('-w', '--workers', type=int,
+                        default=Config.download_workers,
+                        help='Number of concurrent downloads.')
+    parser.add_argument('--resume', action="store_true",
+                        help='Record progress in a manifest and continue an interrupted run, '
+                             'students.csv is appended to as rows finish and rewritten '
+                             'from the export at the end.')
+    parser.add_argument('--validate', action="store_true",
+                        help='Compare checksums of the files in Drive with the manifest and '
+                             'download only new or changed pictures, implies --resume.')
+    parser.add_argument('--profile', action="store_true",
+                        help='Print time spent downloading and the slowest files.')
+    parser.add_argument('--profile-top', type=int, default=10,
+                        help='Number of the slowest files to print.')
+    parser.add_argument('--profile-dump',
+                        help='Save cProfile statistics to this file, implies --profile.')
+    args = parser.parse_args()
+    if args.profile_dump:
+        args.profile = True
+    return args
 
 
 if __name__ == "__main__":
-    DownloadImages(sys.argv[1])
+    args = parse_arguments()
+    if args.profile:
+        profiler.enable(args.profile_dump)
+    DownloadImages(args.csv_file, args.workers, args.resume, args.validate)
+    profile_report(args.profile_top, args.profile_dump)
@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+import threading
+
+from config import Config
+from tools import file_hash
+
+log = logging.getLogger(__name__)
+
+
+class DownloadManifest:
+    """Append-only log of the downloaded pictures, so an interrupted run can
+    continue where it stopped. Each line records the status of one picture
+    with its Drive file ID, md5 of the file in Drive and the sha256 and size
+    of the saved file, the last line of a picture wins. A line with the path
+    and hash of the form export ties the log and students.csv to that export."""
+
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, path: os.path = Config.download_manifest_path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.export = None
+        self.entries = self.load()
+        self.compact()
+
+    def load(self) -> dict:
+        entries = dict()
+        self.num_lines = 0
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, "r") as f:
+            for line in f:
+                self.num_lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be cut off by an interrupted run
+                    log.warning(f"Ignoring a broken line in '{self.path}'")
+                    continue
+                if "export" in entry:
+                    self.export = entry["export"]
+                    continue
+                entries[entry["destination"]] = entry
+        return entries
+
+    def compact(self) -> None:
+        """Rewrites the log with a single line per picture."""
+        lines = [{"export": self.export}] if self.export is not None else []
+        lines.extend(self.entries.values())
+        if self.num_lines == len(lines):
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            for entry in lines:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+        self.num_lines = len(lines)
+
+    def append(self, entry: dict) -> None:
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.num_lines += 1
+
+    def start_export(self, export_path: os.path) -> bool:
+        """Records the form export the following downloads belong to.
+        Returns whether it is the same export as in the previous run,
+        i.e. the run continues an interrupted one."""
+        export = {"path": os.path.abspath(export_path), "sha256": file_hash(export_path)}
+        if export == self.export:
+            return True
+        self.export = export
+        self.append({"export": export})
+        return False
+
+    def record(self, destination: os.path, file_id: str, status: str,
+               md5: str = None) -> None:
+        entry = {"destination": destination, "file_id": file_id, "status": status}
+        if status == self.DONE:
+            entry["md5"] = md5
+            entry["sha256"] = file_hash(destination)
+            entry["size"] = os.path.getsize(destination)
+        self.entries[destination] = entry
+        self.append(entry)
+
+    def is_done(self, destination: os.path, file_id: str) -> bool:
+        """Whether the picture was downloaded from the same file and
+        the saved file is still complete and unchanged."""
+        entry = self.entries.get(destination)
+        if entry is None or entry["status"] != self.DONE or entry["file_id"] != file_id:
+            return False
+        if not os.path.exists(destination) or os.path.getsize(destination) != entry["size"]:
+            return False
+        return file_hash(destination) == entry["sha256"]
+
+    def is_current(self, destination: os.path, md5: str) -> bool:
+        """Whether the saved picture was downloaded from a file with the given
+        md5 checksum in Drive, even when the file ID has changed since."""
+        entry = self.entries.get(destination)
+        if entry is None or entry.get("md5") != md5:
+            return False
+        return self.is_done(destination, entry["file_id"])
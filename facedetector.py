@@ -1,17 +1,49 @@
 import cv2
 import logging
+import math
 import os
-import pickle
 import numpy as np
 
-from PIL import Image, ImageFile, ExifTags, ImageOps
+from PIL import Image, ImageDraw, ImageFile, ExifTags, ImageOps
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 from typing import List
 
-from config import PhotoBlock
+from config import DetectorConfig, PhotoBlock
+from cropcache import CropCache
+from decisionstore import DecisionStore
+from detectors import create_backends
+from profiler import profiler
+from tools import file_hash
 
 log = logging.getLogger(__name__)
 
+# Transpositions that apply the EXIF orientation, same as in ImageOps.exif_transpose
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+def intersection_over_union(a: List[int], b: List[int]) -> float:
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1])
+             - intersection)
+    return intersection / union
+
+
+class Placeholder(BytesIO):
+    """Printed instead of a photo that waits for the review, so that a guessed
+    face of another person never ends up on a card."""
+
 
 class FaceDetector:
     def expand_rects(self, rects: List[List[int]]) -> List[List[int]]:
@@ -40,17 +72,24 @@ class FaceDetector:
 
         return rects
 
-    def detect_faces(self, img: cv2.typing.MatLike, cascade: cv2.CascadeClassifier, expand: bool = True) -> List[List[int]]:
-        rects = cascade.detectMultiScale(
-            img,
-            scaleFactor=1.01,
-            minNeighbors=50,
-            minSize=(100, 100),
-            flags=cv2.CASCADE_SCALE_IMAGE
-        )
+    def detect_faces(self, img: cv2.typing.MatLike, expand: bool = True,
+                     scale: float = 1.0, shape: tuple = None, backends: list = None):
+        """Runs the backends on the image until one of them finds a face,
+        returns the rectangles and their scores. When the image was downscaled,
+        scale is the ratio to the original image with the given shape and
+        the returned rectangles are in the coordinates of the original image."""
+        min_size = max(1, round(DetectorConfig.min_size * scale))
+        for backend in backends or self.backends:
+            rects, scores = backend.detect(img, min_size)
+            if len(rects):
+                break
 
         if len(rects) == 0:
-            return []
+            return [], []
+
+        if scale != 1.0:
+            # Map the rectangles back to the full resolution image
+            rects = np.round(rects / scale).astype(rects.dtype)
 
         if expand:
             rects = self.expand_rects(rects)
@@ -59,11 +98,11 @@ class FaceDetector:
         rects[:, 2:] += rects[:, :2]
 
         # Make sure the rectangle is not larger than the image
-        h, w = img.shape
+        h, w = shape if shape is not None else img.shape
         rects[rects[..., 2] > w, 2] = w
         rects[rects[..., 3] > h, 3] = h
 
-        return rects
+        return rects, scores
 
     def crop_image(self, img: ImageFile, rect: List[int]) -> cv2.typing.MatLike:
         return img.crop(rect)
@@ -89,28 +128,41 @@ class FaceDetector:
         img_out = cv2.cvtColor(img_hsv, cv2.COLOR_HSV2BGR)
         return img_out
 
+    def print_size(self, dpi: int = None) -> tuple:
+        """Size in px of the photo printed at the configured DPI."""
+        dpi = dpi or self.dpi
+        width = round(PhotoBlock.width / 25.4 * dpi)
+        height = round(PhotoBlock.height / 25.4 * dpi)
+        return width, height
+
     def save_image(self, img: ImageFile) -> BytesIO:
         buf = BytesIO()
         rgb_img = img.convert("RGB")
-        rgb_img.save(buf, format="JPEG")
+
+        # The photo is stretched to the PhotoBlock size in the PDF anyway,
+        # so there is no point in keeping more pixels than the printer uses
+        if self.dpi:
+            size = self.print_size()
+            if rgb_img.width > size[0] or rgb_img.height > size[1]:
+                rgb_img = rgb_img.resize(size, Image.Resampling.LANCZOS,
+                                         reducing_gap=3.0)
+
+        rgb_img.save(buf, format="JPEG",
+                     quality=self.jpeg_quality,
+                     optimize=self.jpeg_optimize,
+                     progressive=self.jpeg_progressive)
         buf.seek(0)
         return buf
 
-    def decide_multiple_faces(self, img_path, img, rects: List[List[int]]) -> List[List[int]]:
+    def decide_multiple_faces(self, img_hash: str, img, rects: List[List[int]]) -> List[int]:
 
-        # Load previous decions dict
-        if os.path.exists("decisions.pickle"):
-            with open("decisions.pickle", "rb") as f:
-                prev_decisions = pickle.load(f)
-        else:
-            prev_decisions = dict()
-
-        # Return previous decion if in dict
-        if img_path in prev_decisions.keys():
-            decision = prev_decisions[img_path]
-            log.info(
-                f"Returning previous decision from database: [{decision}]")
-            return rects[decision]
+        # Return previous decion if in the store
+        if self.decisions is not None:
+            decision = self.decisions.get(img_hash)
+            if decision is not None:
+                log.info(
+                    f"Returning previous decision from database: [{decision}]")
+                return decision
 
         # Manual decision as fallback
         # Create folder fo all of the different possible detections
@@ -130,41 +182,393 @@ class FaceDetector:
             os.remove(os.path.join(decision_folder, f"{idx}.jpg"))
 
         # Save the decision
-        prev_decisions[img_path] = selected
-        with open("decisions.pickle", "wb+") as f:
-            pickle.dump(prev_decisions, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.decisions is not None:
+            self.decisions.put(img_hash, rects[selected])
 
         return rects[selected]
 
-    def run(self) -> BytesIO:
+    def working_scale(self, shape: tuple) -> float:
+        """Ratio used to downscale the image before detection, so that
+        its longest side is at most max_side pixels."""
+        longest = max(shape)
+        if not self.max_side or longest <= self.max_side:
+            return 1.0
+        return self.max_side / longest
 
-        log.info(f"Processing '{self.img_path}'")
+    def load_image(self, img_path: os.path) -> ImageFile:
+        pil_img = Image.open(img_path)
+        return ImageOps.exif_transpose(pil_img)
 
+    def prepare_gray(self, pil_img: ImageFile):
+        """Returns the equalized grayscale image used for detection,
+        its scale to the original image and the original shape."""
         # Convert to grayscale
-        pil_gray = self.pil_img.convert('L')
+        pil_gray = pil_img.convert('L')
         gray = np.array(pil_gray)
+        shape = gray.shape
+
+        # Run the detection on a smaller image if configured
+        scale = self.working_scale(shape)
+        if scale != 1.0:
+            size = (round(shape[1] * scale), round(shape[0] * scale))
+            gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
         gray = cv2.equalizeHist(gray)
+        return gray, scale, shape
+
+    def open_raw(self, img_path: os.path):
+        """Opens the image without decoding it, returns it together
+        with its EXIF orientation."""
+        img = Image.open(img_path)
+        orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+        return img, orientation
+
+    def raw_rect(self, rect: List[int], orientation: int, raw_size: tuple) -> List[int]:
+        """Maps a rectangle from the EXIF transposed image back
+        to the coordinates of the image as it is stored in the file."""
+        w, h = raw_size
+        inverse = {
+            1: lambda x, y: (x, y),
+            2: lambda x, y: (w - x, y),
+            3: lambda x, y: (w - x, h - y),
+            4: lambda x, y: (x, h - y),
+            5: lambda x, y: (y, x),
+            6: lambda x, y: (y, h - x),
+            7: lambda x, y: (w - y, h - x),
+            8: lambda x, y: (w - y, x),
+        }[orientation if orientation in ORIENTATION_TRANSPOSE else 1]
+        (x0, y0), (x1, y1) = inverse(rect[0], rect[1]), inverse(rect[2], rect[3])
+        return [min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)]
+
+    def prepare_draft(self, img_path: os.path):
+        """Grayscale image for the detection decoded only in the resolution
+        it needs, see prepare_gray. Only the small grayscale image
+        is EXIF transposed."""
+        img, orientation = self.open_raw(img_path)
+        raw_w, raw_h = img.size
+        shape = (raw_w, raw_h) if orientation in (5, 6, 7, 8) else (raw_h, raw_w)
+        scale = self.working_scale(shape)
+
+        with profiler.stage("decode", img_path):
+            # JPEG decoder can skip the detail the detection does not need
+            img.draft("L", (math.ceil(raw_w * scale), math.ceil(raw_h * scale)))
+            pil_gray = img.convert("L")
+            if orientation in ORIENTATION_TRANSPOSE:
+                pil_gray = pil_gray.transpose(ORIENTATION_TRANSPOSE[orientation])
+
+        with profiler.stage("grayscale", img_path):
+            gray = np.array(pil_gray)
+            size = (round(shape[1] * scale), round(shape[0] * scale))
+            if gray.shape != (size[1], size[0]):
+                gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+            gray = cv2.equalizeHist(gray)
+        return gray, scale, shape
+
+    def crop_draft(self, img_path: os.path, rect: List[int] = None) -> BytesIO:
+        """Crops the image without EXIF transposing the whole image. JPEG images
+        are decoded in the lowest resolution that still has enough pixels
+        for printing the cropped region at the configured DPI."""
+        img, orientation = self.open_raw(img_path)
+        raw_w, raw_h = img.size
+        if rect is None:
+            region = [0, 0, raw_w, raw_h]
+        else:
+            region = self.raw_rect(rect, orientation, img.size)
+
+        if self.dpi:
+            print_w, print_h = self.print_size()
+            if orientation in (5, 6, 7, 8):
+                print_w, print_h = print_h, print_w
+            reduce = min((region[2] - region[0]) / print_w,
+                         (region[3] - region[1]) / print_h)
+            if reduce > 1 and img.draft("RGB", (math.ceil(raw_w / reduce),
+                                                math.ceil(raw_h / reduce))):
+                fx, fy = img.size[0] / raw_w, img.size[1] / raw_h
+                region = [math.floor(region[0] * fx), math.floor(region[1] * fy),
+                          math.ceil(region[2] * fx), math.ceil(region[3] * fy)]
+
+        cropped = img.crop(region)
+        if orientation in ORIENTATION_TRANSPOSE:
+            cropped = cropped.transpose(ORIENTATION_TRANSPOSE[orientation])
+        return self.save_image(cropped)
+
+    def crop_path(self, img_path: os.path, rects: List[List[int]],
+                  pil_img: ImageFile = None) -> BytesIO:
+        """Crops the image around the first face, the image
+        is loaded only if it was not loaded already."""
+        if self.fast_decode:
+            return self.crop_draft(img_path, rects[0] if len(rects) else None)
+        if pil_img is None:
+            with profiler.stage("decode", img_path):
+                pil_img = self.load_image(img_path)
+        return self.crop_face(pil_img, rects)
+
+    def find_faces(self, img_path: os.path, backends: list = None):
+        """Loads the image and returns it together with all detected faces
+        and their scores. With fast decoding the image is not returned,
+        it is opened again for cropping."""
+        pil_img, _, rects, scores = self.detect_path(img_path, backends)
+        return pil_img, rects, scores
+
+    def detect_path(self, img_path: os.path, backends: list = None):
+        """find_faces that also returns the grayscale image of the detection
+        with its scale and shape, so other backends can run on it."""
+        log.info(f"Processing '{img_path}'")
+        if self.fast_decode:
+            pil_img = None
+            gray, scale, shape = self.prepare_draft(img_path)
+        else:
+            with profiler.stage("decode", img_path):
+                pil_img = self.load_image(img_path)
+            with profiler.stage("grayscale", img_path):
+                gray, scale, shape = self.prepare_gray(pil_img)
 
         # Run facial recognition
-        rects = self.detect_faces(gray, self.face_cascade)
-        log.debug(f"Found {len(rects)} faces in {self.img_path}")
+        with profiler.stage("detect", img_path):
+            rects, scores = self.detect_faces(gray, scale=scale, shape=shape,
+                                              backends=backends)
+        log.debug(f"Found {len(rects)} faces in {img_path}")
+
+        return pil_img, (gray, scale, shape), rects, scores
 
+    def crop_face(self, pil_img: ImageFile, rects: List[List[int]]) -> BytesIO:
+        """Crops the photo around the only detected face."""
         if len(rects) == 0:
-            return self.save_image(self.pil_img)
-        elif len(rects) == 1:
-            rect = rects[0]
+            return self.save_image(pil_img)
+        return self.save_image(self.crop_image(pil_img, rects[0]))
+
+    def image_shape(self, img_path: os.path) -> tuple:
+        """Height and width of the EXIF transposed image, read from the header."""
+        img, orientation = self.open_raw(img_path)
+        width, height = img.size
+        return (width, height) if orientation in (5, 6, 7, 8) else (height, width)
+
+    def agreeing_face(self, rects: np.ndarray, detection: tuple) -> List[int]:
+        """The only face that every other backend of the chain found as well,
+        on the grayscale image, scale and shape the faces were found on."""
+        gray, scale, shape = detection
+        others = list()
+        for backend in self.backends:
+            found, _ = self.detect_faces(gray, scale=scale, shape=shape,
+                                         backends=[backend])
+            # The backend that found these faces does not count
+            if len(found) and not np.array_equal(found, rects):
+                others.append(found)
+        if not others:
+            return None
+        agreeing = [rect for rect in rects
+                    if all(max(intersection_over_union(rect, other) for other in found)
+                           >= DetectorConfig.agreement_iou
+                           for found in others)]
+        return agreeing[0] if len(agreeing) == 1 else None
+
+    def choose_face(self, img_path: os.path, rects: np.ndarray,
+                    scores: np.ndarray, detection: tuple) -> List[int]:
+        """Chooses one of multiple faces by the resolve policy. Returns None
+        when the policy cannot tell the faces apart with a clear margin."""
+        if self.resolve_policy == "manual":
+            return None
+        if self.resolve_policy == "agreement":
+            return self.agreeing_face(rects, detection)
+
+        if self.resolve_policy == "largest":
+            values = (rects[:, 2] - rects[:, 0]) * (rects[:, 3] - rects[:, 1])
+        elif self.resolve_policy == "confidence":
+            values = np.asarray(scores)
         else:
-            log.warn("Found multiple faces. Choose the right one from the folder 'decisions' and then write the number of the chosen picture here")
-            rect = self.decide_multiple_faces(
-                self.img_path, self.pil_img, rects)
-
-        cropped_img = self.crop_image(self.pil_img, rect)
-
-        return self.save_image(cropped_img)
+            height, width = self.image_shape(img_path)
+            distance = np.hypot((rects[:, 0] + rects[:, 2] - width) / 2,
+                                (rects[:, 1] + rects[:, 3] - height) / 2)
+            values = 1 / (distance + 1)
+
+        order = np.argsort(values)[::-1]
+        if values[order[0]] >= DetectorConfig.resolve_margin * values[order[1]]:
+            return rects[order[0]]
+        return None
+
+    def placeholder(self) -> Placeholder:
+        """Grey crossed out photo, clearly not ready to be printed."""
+        width, height = self.print_size(self.dpi or PhotoBlock.dpi or 300)
+        img = Image.new("RGB", (width, height), (200, 200, 200))
+        draw = ImageDraw.Draw(img)
+        line_width = max(1, width // 50)
+        draw.line((0, 0, width, height), fill=(120, 120, 120), width=line_width)
+        draw.line((0, height, width, 0), fill=(120, 120, 120), width=line_width)
+        draw.text((width // 10, height // 10), "IN REVIEW", fill=(0, 0, 0))
+        buf = Placeholder()
+        img.save(buf, format="JPEG", quality=self.jpeg_quality)
+        buf.seek(0)
+        return buf
 
-    def __init__(self, img_path: os.path, casc_path: os.path) -> None:
-        pil_img = Image.open(img_path)
-        pil_img = ImageOps.exif_transpose(pil_img)
-        self.pil_img = pil_img
-        self.img_path = img_path
-        self.face_cascade = cv2.CascadeClassifier(casc_path)
+    def enqueue(self, img_path: os.path, rects: List[List[int]]) -> BytesIO:
+        """Queues the photo for review.py and returns a placeholder for this
+        run. Nothing is cached, so the next run uses the decision."""
+        if self.decisions is None:
+            return self.resolve(img_path, rects)
+        log.warning(f"Found multiple faces in '{img_path}', printing a placeholder "
+                    f"until it is reviewed with review.py")
+        self.decisions.enqueue(file_hash(img_path), img_path, rects)
+        profiler.count("queued_for_review")
+        return self.placeholder()
+
+    def resolve(self, img_path: os.path, rects: List[List[int]]) -> BytesIO:
+        """Lets the user choose between multiple faces found in the image."""
+        log.warn(f"Found multiple faces in '{img_path}'. Choose the right one from the folder 'decisions' and then write the number of the chosen picture here")
+        pil_img = self.load_image(img_path)
+        img_hash = file_hash(img_path)
+        rect = self.decide_multiple_faces(img_hash, pil_img, rects)
+        cropped = self.crop_path(img_path, [rect], pil_img)
+        self.store(img_hash, cropped)
+        return cropped
+
+    def params(self) -> tuple:
+        """All settings that affect the resulting crop."""
+        photo_block = tuple((k, v) for k, v in vars(PhotoBlock).items()
+                            if not k.startswith("_"))
+        return (tuple(backend.params() for backend in self.backends),
+                self.max_side, DetectorConfig.min_size, photo_block, self.dpi,
+                self.jpeg_quality, self.jpeg_optimize, self.jpeg_progressive,
+                self.fast_decode, self.resolve_policy, DetectorConfig.resolve_margin,
+                DetectorConfig.agreement_iou)
+
+    def cached(self, img_hash: str) -> BytesIO:
+        if self.cache is None:
+            return None
+        return self.cache.get(self.cache.key(img_hash, self.params()))
+
+    def store(self, img_hash: str, cropped: BytesIO) -> None:
+        if self.cache is not None:
+            self.cache.put(self.cache.key(img_hash, self.params()), cropped)
+
+    def process(self, img_path: os.path):
+        """Returns the cropped photo, or None and the detected faces
+        when a decision from the user is needed."""
+        with profiler.stage("hash", img_path):
+            img_hash = file_hash(img_path)
+        cropped = self.cached(img_hash)
+        if cropped is not None:
+            log.info(f"Using cached crop of '{img_path}'")
+            return cropped, []
+
+        # The face was already chosen by the user, no need to detect it again
+        rect = self.decisions.get(img_hash) if self.decisions is not None else None
+        if rect is not None:
+            log.info(f"Using previous decision for '{img_path}'")
+            pil_img, rects = None, [rect]
+        else:
+            pil_img, detection, rects, scores = self.detect_path(img_path)
+            if len(rects) > 1:
+                rect = self.choose_face(img_path, rects, scores, detection)
+                if rect is None:
+                    return None, rects
+                log.info(f"Chose face {list(rect)} of {len(rects)} in '{img_path}' "
+                         f"by the {self.resolve_policy} policy")
+                profiler.count("auto_resolved")
+                rects = [rect]
+
+        with profiler.stage("crop_encode", img_path):
+            cropped = self.crop_path(img_path, rects, pil_img)
+        self.store(img_hash, cropped)
+        return cropped, rects
+
+    def run(self, img_path: os.path) -> BytesIO:
+        """Detects the face on a single image and returns the cropped photo."""
+        cropped, rects = self.process(img_path)
+        if cropped is None:
+            cropped = self.decide(img_path, rects)
+        return cropped
+
+    def decide(self, img_path: os.path, rects: List[List[int]]) -> BytesIO:
+        if self.queue_review:
+            return self.enqueue(img_path, rects)
+        return self.resolve(img_path, rects)
+
+    def create_pool(self, workers: int) -> ProcessPoolExecutor:
+        """Process pool with a copy of this detector in every worker."""
+        return ProcessPoolExecutor(max_workers=workers,
+                                   initializer=_init_worker,
+                                   initargs=(self, profiler.enabled))
+
+    def map_in_pool(self, executor: ProcessPoolExecutor, img_paths: List[os.path]) -> list:
+        results = list()
+        for result, measurements in executor.map(_process_in_worker, img_paths):
+            profiler.merge(measurements)
+            results.append(result)
+        return results
+
+    def run_many(self, img_paths: List[os.path], workers: int = 1,
+                 executor: ProcessPoolExecutor = None) -> List[BytesIO]:
+        """Crops all images, detection runs in a process pool when more than one
+        worker is requested. Images with multiple faces that the resolve policy
+        cannot decide are resolved by the user, or queued for the review,
+        in one pass after all the other photos are done. The result is
+        in the same order as the input. An existing pool from create_pool
+        can be passed in to reuse it between calls."""
+        if executor is not None:
+            results = self.map_in_pool(executor, img_paths)
+        elif workers > 1 and len(img_paths) > 1:
+            with self.create_pool(workers) as executor:
+                results = self.map_in_pool(executor, img_paths)
+        else:
+            results = [self.process(img_path) for img_path in img_paths]
+
+        crops = list()
+        for img_path, (cropped, rects) in zip(img_paths, results):
+            if cropped is None:
+                cropped = self.decide(img_path, rects)
+            crops.append(cropped)
+
+        if self.cache is not None:
+            self.cache.evict()
+        return crops
+
+    def __init__(self, casc_path: os.path,
+                 max_side: int = DetectorConfig.max_side,
+                 preset: str = DetectorConfig.preset,
+                 cache: CropCache = None,
+                 decisions: DecisionStore = None,
+                 dpi: int = PhotoBlock.dpi,
+                 jpeg_quality: int = PhotoBlock.jpeg_quality,
+                 jpeg_optimize: bool = PhotoBlock.jpeg_optimize,
+                 jpeg_progressive: bool = PhotoBlock.jpeg_progressive,
+                 fast_decode: bool = DetectorConfig.fast_decode,
+                 backends: List[str] = DetectorConfig.backends,
+                 resolve_policy: str = DetectorConfig.resolve_policy,
+                 queue_review: bool = DetectorConfig.queue_review) -> None:
+        if preset not in DetectorConfig.presets:
+            raise ValueError(f"Unknown detection preset '{preset}'")
+        if resolve_policy not in DetectorConfig.resolve_policies:
+            raise ValueError(f"Unknown resolve policy '{resolve_policy}'")
+        if resolve_policy == "agreement" and len(backends) < 2:
+            raise ValueError("The agreement resolve policy needs at least two backends")
+        self.casc_path = casc_path
+        self.max_side = max_side
+        self.preset = preset
+        self.backends = create_backends(backends, casc_path, preset)
+        self.cache = cache
+        self.decisions = decisions
+        self.dpi = dpi
+        self.jpeg_quality = jpeg_quality
+        self.jpeg_optimize = jpeg_optimize
+        self.jpeg_progressive = jpeg_progressive
+        self.fast_decode = fast_decode
+        self.resolve_policy = resolve_policy
+        self.queue_review = queue_review
+
+
+# Detector used by the worker processes of FaceDetector.run_many
+_worker_detector: FaceDetector = None
+
+
+def _init_worker(detector: FaceDetector, profile: bool) -> None:
+    global _worker_detector
+    _worker_detector = detector
+    # Forget measurements copied from the parent when the worker was forked
+    profiler.drain()
+    profiler.enabled = profile
+
+
+def _process_in_worker(img_path: os.path):
+    """Returns the result of FaceDetector.process together with
+    the profiler measurements, so the main process can merge them."""
+    result = _worker_detector.process(img_path)
+    return result, profiler.drain()
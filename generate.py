@@ -2,33 +2,217 @@ import csv
 import logging
 import argparse
 import os
+import time
 
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List
+from functools import lru_cache
+from io import BytesIO
+from typing import TYPE_CHECKING, ClassVar, Iterable, Iterator, List
 from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Image
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
 from reportlab.lib.units import mm
+from reportlab.pdfgen.canvas import Canvas
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfbase import pdfmetrics
 
-from config import Config, PrintMode, TextBlock, PhotoBlock, PageConfig
-from facedetector import FaceDetector
+from canvaslayout import CanvasLayout
+from config import Config, DetectorConfig, PrintMode, Renderer, TextBlock, PhotoBlock, PageConfig
+from cropcache import CropCache
+from decisionstore import DecisionStore
+from incremental import IncrementalBuild
+from pdfimages import Photo, draw_image, pdf_settings
+from profiler import profiler, report as profile_report
+
+if TYPE_CHECKING:
+    from facedetector import FaceDetector
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-pdfmetrics.registerFont(TTFont('Lato', './fonts/Lato-Regular.ttf'))
+# Styles of the card cells, shared by all cards instead of one per card
+TEXT_CELL_STYLE = TableStyle([
+    ("FONTNAME", (0, 0), (-1, -1), TextBlock.font),
+    ("FONTSIZE", (0, 0), (-1, -1), TextBlock.font_size),
+    ("TOPPADDING", (0, 0), (-1, -1), 0),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 0),
+    ("LEFTPADDING", (0, 0), (-1, -1), 0.5*mm),
+    ("RIGHTPADDING", (0, 0), (-1, -1), 0.5*mm)
+])
+PHOTO_CELL_STYLE = TableStyle([
+    ("FONTNAME", (0, 0), (-1, -1), PhotoBlock.font),
+    ("FONTSIZE", (0, 0), (-1, -1), PhotoBlock.font_size*mm),
+    ("TOPPADDING", (0, 0), (-1, -1), 0),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 0),
+    ("LEFTPADDING", (0, 0), (-1, -1), 0),
+    ("RIGHTPADDING", (0, 0), (-1, -1), 0),
+    ("VALIGN", (0, 0), (-1, -1), "TOP"),
+    ("ALIGN", (0, 0), (-1, -1), "CENTER")
+])
+
 
-@dataclass
+def register_fonts() -> None:
+    """Registers the fonts of the cards, done once before the first PDF
+    is created instead of on import."""
+    if 'Lato' not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont('Lato', './fonts/Lato-Regular.ttf'))
+
+@dataclass(slots=True)
 class StudentInfo:
+    """One row of students.csv. Section and university are the same
+    for all students, so they are kept on the class, not in every record."""
     name: str
     date_of_birth: str
     nationality: str
     today: str
     img_destination: str
-    section: str = Config.section
-    university: str = Config.university
+    section: ClassVar[str] = Config.section
+    university: ClassVar[str] = Config.university
+
+
+# Number of columns of students.csv, the fields of StudentInfo
+STUDENT_COLUMNS = 5
+
+
+@lru_cache(maxsize=4096)
+def is_card_date(value: str) -> bool:
+    """Most rows share their dates, so every distinct value is parsed once."""
+    try:
+        datetime.strptime(value, Config.card_date_format)
+        return True
+    except ValueError:
+        return False
+
+
+class InvalidStudents(ValueError):
+    """Problems of all bad rows of the students CSV."""
+
+    def __init__(self, csv_path: str, errors: List[str]) -> None:
+        super().__init__(f"Found {len(errors)} problems in {csv_path}")
+        self.csv_path = csv_path
+        self.errors = errors
+
+
+def validate_rows(rows: Iterable[List[str]], check_images: bool) -> List[str]:
+    """Checks all rows in one pass before any expensive work starts
+    and returns the problems of all bad rows."""
+    errors = list()
+    for line_no, row in enumerate(rows, 1):
+        if len(row) != STUDENT_COLUMNS:
+            errors.append(f"line {line_no}: expected {STUDENT_COLUMNS} columns, "
+                          f"found {len(row)}")
+            continue
+        name, date_of_birth, _, today, img_destination = row
+        if not is_card_date(date_of_birth):
+            errors.append(f"line {line_no}: invalid date of birth '{date_of_birth}' "
+                          f"of {name}")
+        if not is_card_date(today):
+            errors.append(f"line {line_no}: invalid date of issue '{today}' of {name}")
+        if check_images and not os.path.isfile(img_destination):
+            errors.append(f"line {line_no}: missing photo '{img_destination}' of {name}")
+    return errors
+
+
+def validate_students(csv_path: str, check_images: bool) -> List[str]:
+    """Checks all rows of students.csv, see validate_rows."""
+    with open(csv_path, "r", newline="") as f:
+        return validate_rows(csv.reader(f), check_images)
+
+
+def add_detector_arguments(parser: argparse.ArgumentParser) -> None:
+    """Options of the face detection, of the photos in the PDF
+    and of profiling, shared with pipeline.py"""
+    parser.add_argument('-w', '--workers', type=int,
+                        default=Config.workers,
+                        help=f'Number of processes used for face detection')
+    parser.add_argument('--detect-max-side', type=int,
+                        default=DetectorConfig.max_side,
+                        help=f'Downscale photos to this longest side in px '
+                             f'before face detection, 0 disables it')
+    parser.add_argument('--detect-preset',
+                        choices=list(DetectorConfig.presets),
+                        default=DetectorConfig.preset,
+                        help=f'Speed/accuracy preset of the face detection')
+    parser.add_argument('--detect-backends', nargs='+',
+                        choices=['haar', 'yunet'],
+                        default=DetectorConfig.backends,
+                        help=f'Face detection backends tried in order, the next one is used '
+                             f'when a backend finds no face')
+    parser.add_argument('--resolve-policy',
+                        choices=DetectorConfig.resolve_policies,
+                        default=DetectorConfig.resolve_policy,
+                        help=f'How to choose between multiple faces in a photo, '
+                             f'manual asks the user')
+    parser.add_argument('--queue-review', action="store_true",
+                        default=DetectorConfig.queue_review,
+                        help=f'Queue photos the policy cannot decide for review.py '
+                             f'and print a placeholder until then, instead of asking')
+    parser.add_argument('--fast-decode', action="store_true",
+                        default=DetectorConfig.fast_decode,
+                        help=f'Decode JPEG photos only in the resolution needed '
+                             f'for the detection and for printing')
+    parser.add_argument('--dpi', type=int, default=PhotoBlock.dpi,
+                        help=f'Resolution of the photos in the PDF, '
+                             f'0 keeps the original size')
+    parser.add_argument('--jpeg-quality', type=int,
+                        default=PhotoBlock.jpeg_quality,
+                        help=f'JPEG quality of the photos in the PDF')
+    parser.add_argument('--jpeg-optimize', action="store_true",
+                        default=PhotoBlock.jpeg_optimize,
+                        help=f'Use optimized JPEG encoding')
+    parser.add_argument('--jpeg-progressive', action="store_true",
+                        default=PhotoBlock.jpeg_progressive,
+                        help=f'Use progressive JPEG encoding')
+    parser.add_argument('--no-cache', dest="cache", action="store_false",
+                        help=f'Do not use the cache of cropped photos')
+    parser.add_argument('--profile', action="store_true",
+                        help=f'Print time spent in each stage and the slowest photos')
+    parser.add_argument('--profile-top', type=int, default=10,
+                        help=f'Number of the slowest photos to print')
+    parser.add_argument('--profile-dump',
+                        help=f'Save cProfile statistics of the main process to this file, '
+                             f'implies --profile')
+
+
+def check_detector_arguments(parser: argparse.ArgumentParser,
+                             args: argparse.Namespace) -> None:
+    """Checks the combinations of the options of add_detector_arguments."""
+    if args.profile_dump:
+        # The statistics are only collected while profiling
+        args.profile = True
+    if args.resolve_policy == "agreement" and len(args.detect_backends) < 2:
+        parser.error("--resolve-policy agreement needs at least two --detect-backends, "
+                     "e.g. --detect-backends yunet haar")
+    if args.detect_backends != ["haar"]:
+        # OpenCV is imported only when other backends than the default are asked for
+        from detectors import create_backends
+        try:
+            create_backends(args.detect_backends, Config.casc_path, args.detect_preset)
+        except ValueError as e:
+            parser.error(str(e))
+
+
+def create_detector(args: argparse.Namespace) -> "FaceDetector":
+    # OpenCV, numpy and PIL are imported only when photos are processed
+    from facedetector import FaceDetector
+    return FaceDetector(Config.casc_path,
+                        args.detect_max_side,
+                        args.detect_preset,
+                        CropCache() if args.cache else None,
+                        DecisionStore(),
+                        args.dpi,
+                        args.jpeg_quality,
+                        args.jpeg_optimize,
+                        args.jpeg_progressive,
+                        args.fast_decode,
+                        args.detect_backends,
+                        args.resolve_policy,
+                        args.queue_review)
+
+
+def default_output_path(mode: PrintMode, date: datetime) -> os.path:
+    filename = f"output-{mode}-{date.strftime('%Y_%m_%d_%H_%M')}.pdf"
+    return os.path.join(os.getcwd(), "output", filename)
 
 
 class Generate:
@@ -38,6 +222,7 @@ class Generate:
 
     students: List[StudentInfo] = list()
     args: argparse.Namespace
+    _detector: "FaceDetector" = None
 
     def parse_arguments(self):
         """Load arguments from CLI"""
@@ -55,36 +240,103 @@ class Generate:
                             type=PrintMode, choices=list(PrintMode),
                             default=PrintMode.TEXT_ONLY,
                             help=f'Printing mode - text or images')
-        return parser.parse_args()
+        parser.add_argument('-r', '--renderer',
+                            type=Renderer, choices=list(Renderer),
+                            default=Renderer.TABLE,
+                            help=f'Layout engine used to build the PDF')
+        parser.add_argument('-s', '--stream', action="store_true",
+                            help=f'Read the CSV lazily and process one page at a time '
+                                 f'to keep memory usage low, implies the canvas renderer')
+        parser.add_argument('--incremental', action="store_true",
+                            help=f'Copy pages with unchanged students from the previous output '
+                                 f'and render only the changed ones, implies the canvas renderer')
+        parser.add_argument('--delta', action="store_true",
+                            help=f'With --incremental, also create a PDF with only new '
+                                 f'or changed students')
+        parser.add_argument('--clear-cache', action="store_true",
+                            help=f'Remove all cropped photos from the cache and exit')
+        add_detector_arguments(parser)
+        args = parser.parse_args()
+        check_detector_arguments(parser, args)
+        return args
+
+    def __init__(self, args: argparse.Namespace = None):
+        """Arguments are loaded from CLI when they are not given"""
+        self.args = args or self.parse_arguments()
+        register_fonts()
+
+    @property
+    def detector(self) -> "FaceDetector":
+        """Face detector created on first use, text mode never needs it."""
+        if self._detector is None:
+            self._detector = create_detector(self.args)
+        return self._detector
 
-    def __init__(self):
-        """Main run of the program"""
-        self.args = self.parse_arguments()
-        self.students = self.load_students(self.args.student_csv_path)
-        log.info(f"Loaded {len(self.students)} from csv file")
+    def run(self):
+        """Main run of the program, raises InvalidStudents
+        when the students CSV has bad rows"""
+        if self.args.profile:
+            profiler.enable(self.args.profile_dump)
+        if self.args.clear_cache:
+            CropCache().clear()
+            return
+        if self.args.incremental:
+            self.args.renderer = Renderer.CANVAS
+            self.args.stream = False
+        with profiler.stage("validate_csv"):
+            errors = validate_students(self.args.student_csv_path,
+                                       self.args.mode == PrintMode.PHOTO_ONLY)
+        if errors:
+            raise InvalidStudents(self.args.student_csv_path, errors)
+        if self.args.stream:
+            self.args.renderer = Renderer.CANVAS
+            self.students = self.iter_students(self.args.student_csv_path)
+        else:
+            with profiler.stage("load_csv"):
+                self.students = self.load_students(self.args.student_csv_path)
+            log.info(f"Loaded {len(self.students)} from csv file")
         date = datetime.now()
+        start = time.perf_counter()
 
+        filepath = self.args.output or default_output_path(self.args.mode, date)
         if self.args.mode == PrintMode.TEXT_ONLY:
-            filename = f"output-text-{date.strftime('%Y_%m_%d_%H_%M')}.pdf"
-            filepath = os.path.join(os.getcwd(), "output", filename)
-            self.create_text_pdf(filepath)
+            with profiler.stage("create_pdf"):
+                self.create_text_pdf(filepath)
 
         elif self.args.mode == PrintMode.PHOTO_ONLY:
-            filename = f"output-photo-{date.strftime('%Y_%m_%d_%H_%M')}.pdf"
-            filepath = os.path.join(os.getcwd(), "output", filename)
-            self.create_photo_pdf(filepath)
+            self.import_legacy_decisions()
+            with profiler.stage("create_pdf"):
+                self.create_photo_pdf(filepath)
 
 
         log.info("Created PDF file with mode "
-                 f"{self.args.mode} at {filepath}")
+                 f"{self.args.mode} at {filepath} using {self.args.renderer} "
+                 f"renderer in {time.perf_counter() - start:.2f}s")
+        profile_report(self.args.profile_top, self.args.profile_dump)
+
+    def import_legacy_decisions(self) -> None:
+        """One-time import of decisions.pickle into the decision store.
+        The indexes in the pickle refer to faces found with the default
+        detector settings, so those are used for the import."""
+        legacy_path = Config.legacy_decisions_path
+        if not os.path.exists(legacy_path):
+            return
+        from facedetector import FaceDetector
+        detector = FaceDetector(Config.casc_path)
+        self.detector.decisions.import_pickle(legacy_path, detector)
+        os.rename(legacy_path, f"{legacy_path}.imported")
+
+    def iter_students(self, csv_path: str) -> Iterator[StudentInfo]:
+        """Reads students from the intermediary students.csv file one by one."""
+        with open(csv_path, "r", newline="") as f:
+            csv_reader = csv.reader(f)
+            for line in csv_reader:
+                yield StudentInfo(*line)
 
     def load_students(self, csv_path: str) -> List[StudentInfo]:
         """Loads processed data from intermediary students.cv file,
         this file was generated dy download_photos.py"""
-        with open(csv_path, "r") as f:
-            csv_reader = csv.reader(f)
-            students = [StudentInfo(*line) for line in csv_reader]
-        return students
+        return list(self.iter_students(csv_path))
 
     def generate_text_subtable(self, si: StudentInfo) -> Table:
         """Generates contents of single cell in a table used in text mode."""
@@ -94,40 +346,53 @@ class Generate:
                       [si.section, si.today]]
         table = Table(table_data,
                       colWidths=(TextBlock.width1*mm, TextBlock.width2*mm),
-                      rowHeights=[TextBlock.row_height*mm]*4)
-        table.setStyle(TableStyle([
-            ("FONTNAME", (0, 0), (-1, -1), TextBlock.font),
-            ("FONTSIZE", (0, 0), (-1, -1), TextBlock.font_size),
-            ("TOPPADDING", (0, 0), (-1, -1), 0),
-            ("BOTTOMPADDING", (0, 0), (-1, -1), 0),
-            ("LEFTPADDING", (0, 0), (-1, -1), 0.5*mm),
-            ("RIGHTPADDING", (0, 0), (-1, -1), 0.5*mm)
-        ]))
+                      rowHeights=[TextBlock.row_height*mm]*4,
+                      style=TEXT_CELL_STYLE)
         return table
 
-    def generate_photo_subtable(self, si: StudentInfo) -> Table:
+    def generate_photo_subtable(self, si: StudentInfo, img_cropped: BytesIO) -> Table:
         """Generates contents of single cell in a table used in photo mode."""
-        img_detector = FaceDetector(si.img_destination, Config.casc_path)
-        img_cropped = img_detector.run()
-        img = Image(img_cropped,
+        img = Photo(img_cropped,
                     width=PhotoBlock.width*mm,
                     height=PhotoBlock.height*mm)
         table_data = [[img], [f"{si.name}"]]
         table = Table(table_data,
                       colWidths=(PhotoBlock.width*mm),
-                      rowHeights=[PhotoBlock.height*mm, 2*mm])
-        table.setStyle(TableStyle([
-            ("FONTNAME", (0, 0), (-1, -1), PhotoBlock.font),
-            ("FONTSIZE", (0, 0), (-1, -1), PhotoBlock.font_size*mm),
-            ("TOPPADDING", (0, 0), (-1, -1), 0),
-            ("BOTTOMPADDING", (0, 0), (-1, -1), 0),
-            ("LEFTPADDING", (0, 0), (-1, -1), 0),
-            ("RIGHTPADDING", (0, 0), (-1, -1), 0),
-            ("VALIGN", (0, 0), (-1, -1), "TOP"),
-            ("ALIGN", (0, 0), (-1, -1), "CENTER")
-        ]))
+                      rowHeights=[PhotoBlock.height*mm, 2*mm],
+                      style=PHOTO_CELL_STYLE)
         return table
 
+    def draw_text_block(self, canvas: Canvas, x: float, y: float, si: StudentInfo) -> None:
+        """Draws a single card in text mode, the counterpart of generate_text_subtable."""
+        rows = [[si.name, ""],
+                [si.nationality, si.date_of_birth],
+                [si.university, ""],
+                [si.section, si.today]]
+        # Card is aligned to the bottom of the cell and centered
+        left = x + (TextBlock.width - TextBlock.width1 - TextBlock.width2) / 2 * mm
+        bottom = y + 1*mm
+        # Same baseline offset as platypus uses with its default leading
+        baseline = 12 - TextBlock.font_size
+        canvas.setFont(TextBlock.font, TextBlock.font_size)
+        for idx, (left_text, right_text) in enumerate(rows):
+            row_y = bottom + (len(rows) - 1 - idx) * TextBlock.row_height*mm
+            canvas.drawString(left + 0.5*mm, row_y + baseline, left_text)
+            canvas.drawString(left + (TextBlock.width1 + 0.5)*mm,
+                              row_y + baseline, right_text)
+
+    def draw_photo_block(self, canvas: Canvas, x: float, y: float, block: tuple) -> None:
+        """Draws a single card in photo mode, the counterpart of generate_photo_subtable."""
+        si, img_cropped = block
+        left = x + 1*mm
+        bottom = y + 1*mm
+        draw_image(canvas, img_cropped, left, bottom + 2*mm,
+                   width=PhotoBlock.width*mm,
+                   height=PhotoBlock.height*mm)
+        canvas.setFont(PhotoBlock.font, PhotoBlock.font_size*mm)
+        canvas.drawCentredString(left + PhotoBlock.width / 2 * mm,
+                                 bottom + (2 - PhotoBlock.font_size)*mm,
+                                 si.name)
+
     def generate_text_table(self, students: List[StudentInfo]) -> List[Table]:
         """Generates data used to build table in text mode"""
         table_data = list()
@@ -137,21 +402,119 @@ class Generate:
 
     def generate_photo_table(self, students: List[StudentInfo]) -> List[Table]:
         """Generates data used to build table in photo mode"""
+        with profiler.stage("crop_photos"):
+            crops = self.detector.run_many(
+                [student.img_destination for student in students],
+                self.args.workers)
         table_data = list()
-        for student in students:
-            table_data.append(self.generate_photo_subtable(student))
+        for student, img_cropped in zip(students, crops):
+            table_data.append(self.generate_photo_subtable(student, img_cropped))
         return table_data
 
+    def text_layout(self, output_path: os.path) -> CanvasLayout:
+        return CanvasLayout(output_path,
+                            num_columns=int(210 // TextBlock.width),
+                            col_width=TextBlock.width * mm,
+                            row_height=TextBlock.height * mm)
+
+    def photo_layout(self, output_path: os.path, chunk_pages: int = 0) -> CanvasLayout:
+        return CanvasLayout(output_path,
+                            num_columns=int(210 // (PhotoBlock.width+1)),
+                            col_width=(PhotoBlock.width + 2) * mm,
+                            row_height=(PhotoBlock.height + 4) * mm,
+                            chunk_pages=chunk_pages)
+
+    def stream_chunk_pages(self) -> int:
+        """Concatenating the parts of the streamed output needs pypdf."""
+        try:
+            import pypdf  # noqa: F401
+        except ImportError:
+            log.warning("Install pypdf to write the output in parts, with --stream "
+                        "all pages are kept in memory until the PDF is saved")
+            return 0
+        return PageConfig.stream_chunk_pages
+
+    def draw_pages(self, layout: CanvasLayout, pages: List[List[StudentInfo]]) -> None:
+        """Draws the given pages of students and saves the PDF,
+        photos of all the pages are cropped at once."""
+        if self.args.mode == PrintMode.PHOTO_ONLY:
+            with profiler.stage("crop_photos"):
+                crops = iter(self.detector.run_many(
+                    [student.img_destination for page in pages for student in page],
+                    self.args.workers))
+            pages = [[(student, next(crops)) for student in page] for page in pages]
+            draw_block = self.draw_photo_block
+        else:
+            draw_block = self.draw_text_block
+        for page in pages:
+            layout.draw_page(page, draw_block)
+        layout.save()
+
+    def create_incremental_pdf(self, output_path: os.path) -> None:
+        """Renders only pages whose students changed since the previous run
+        and copies the rest from the previous output."""
+        photo_mode = self.args.mode == PrintMode.PHOTO_ONLY
+        make_layout = self.photo_layout if photo_mode else self.text_layout
+        block = PhotoBlock if photo_mode else TextBlock
+        params = (str(self.args.mode), PageConfig.page_size,
+                  tuple((k, v) for k, v in vars(block).items() if not k.startswith("_")),
+                  self.detector.params() if photo_mode else None)
+        build = IncrementalBuild(
+            Config.manifest_path.format(mode=self.args.mode), params)
+
+        fingerprints = [build.student_fingerprint(
+                            student, student.img_destination if photo_mode else None)
+                        for student in self.students]
+        rendered_path = f"{output_path}.rendered"
+        layout = make_layout(rendered_path)
+        pages = list(layout.paginate(list(zip(self.students, fingerprints))))
+        page_fingerprints = [build.page_fingerprint([fp for _, fp in page])
+                             for page in pages]
+
+        reused = build.reusable_pages(page_fingerprints)
+        changed = [[student for student, _ in page]
+                   for idx, page in enumerate(pages) if idx not in reused]
+        log.info(f"Reusing {len(reused)} pages, rendering {len(changed)} pages")
+        if changed:
+            self.draw_pages(layout, changed)
+        build.assemble(output_path, len(pages), reused, rendered_path)
+        build.save(output_path, page_fingerprints,
+                   [[fp for _, fp in page] for page in pages])
+
+        if self.args.delta:
+            new_students = [student for student, fp in zip(self.students, fingerprints)
+                            if not build.is_known(fp)]
+            delta_path = f"{os.path.splitext(output_path)[0]}-delta.pdf"
+            if new_students:
+                layout = make_layout(delta_path)
+                self.draw_pages(layout, list(layout.paginate(new_students)))
+                log.info(f"Created delta PDF with {len(new_students)} "
+                         f"new or changed students at {delta_path}")
+            else:
+                log.info("No new or changed students, delta PDF was not created")
+
     def create_text_pdf(self, output_path: os.path) -> None:
         """Generates a PDF when in text mode"""
+        if self.args.incremental:
+            self.create_incremental_pdf(output_path)
+            return
+        if self.args.renderer == Renderer.CANVAS:
+            layout = self.text_layout(output_path)
+            layout.render(self.students, self.draw_text_block)
+            return
+
+        table_data = self.generate_text_table(self.students)
+        self.build_text_pdf(output_path, table_data)
+
+    def build_text_pdf(self, output_path: os.path, table_data: List[Table]) -> None:
+        """Lays out the text mode cells into a table and writes the PDF"""
         doc = SimpleDocTemplate(output_path,
                                 pagesize=PageConfig.page_size,
                                 leftMargin=PageConfig.margin_left,
                                 rightMargin=PageConfig.margin_right,
                                 topMargin=PageConfig.margin_top,
-                                bottomMargin=PageConfig.margin_bottom)
-
-        table_data = self.generate_text_table(self.students)
+                                bottomMargin=PageConfig.margin_bottom,
+                                pageCompression=PageConfig.compression)
 
         # Number of columns that can fir in 210mm
         num_columns = 210 // TextBlock.width
@@ -172,18 +535,57 @@ class Generate:
             ("RIGHTPADDING", (0, 0), (-1, -1), 1*mm),
             ("ALIGN", (0, 0), (-1, -1), "CENTER"),
         ]))
-        doc.build([main_table])
+        with pdf_settings():
+            doc.build([main_table])
+
+    def stream_photo_pages(self, layout: CanvasLayout) -> None:
+        """Crops and draws the photos one page at a time, so only the photos
+        of the current page are kept in memory. Faces that need a decision
+        are asked about at the end of each page."""
+        executor = None
+        if self.args.workers > 1:
+            executor = self.detector.create_pool(self.args.workers)
+        try:
+            for page in layout.paginate(self.students):
+                crops = self.detector.run_many(
+                    [student.img_destination for student in page],
+                    executor=executor)
+                layout.draw_page(list(zip(page, crops)), self.draw_photo_block)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        layout.save()
 
     def create_photo_pdf(self, output_path: os.path) -> None:
         """Generates a PDF when in photo mode"""
+        if self.args.incremental:
+            self.create_incremental_pdf(output_path)
+            return
+        if self.args.renderer == Renderer.CANVAS:
+            if self.args.stream:
+                self.stream_photo_pages(
+                    self.photo_layout(output_path, self.stream_chunk_pages()))
+                return
+            layout = self.photo_layout(output_path)
+            with profiler.stage("crop_photos"):
+                crops = self.detector.run_many(
+                    [student.img_destination for student in self.students],
+                    self.args.workers)
+            layout.render(zip(self.students, crops), self.draw_photo_block)
+            return
+
+        table_data = self.generate_photo_table(self.students)
+        self.build_photo_pdf(output_path, table_data)
+
+    def build_photo_pdf(self, output_path: os.path, table_data: List[Table]) -> None:
+        """Lays out the photo mode cells into a table and writes the PDF"""
         doc = SimpleDocTemplate(output_path,
                                 pagesize=PageConfig.page_size,
                                 leftMargin=PageConfig.margin_left,
                                 rightMargin=PageConfig.margin_right,
                                 topMargin=PageConfig.margin_top,
-                                bottomMargin=PageConfig.margin_bottom)
-
-        table_data = self.generate_photo_table(self.students)
+                                bottomMargin=PageConfig.margin_bottom,
+                                pageCompression=PageConfig.compression)
 
         # Number of columns that can fir in 210mm
         num_columns = 210 // (PhotoBlock.width+1)
@@ -203,8 +605,19 @@ class Generate:
             ("LEFTPADDING", (0, 0), (-1, -1), 1*mm),
             ("RIGHTPADDING", (0, 0), (-1, -1), 1*mm),
         ]))
-        doc.build([main_table])
+        with pdf_settings():
+            doc.build([main_table])
+
+
+def main():
+    try:
+        Generate().run()
+    except InvalidStudents as e:
+        for error in e.errors:
+            log.error(f"{e.csv_path}, {error}")
+        log.error(f"{e}, fix them and run again")
+        exit(1)
 
 
 if __name__ == "__main__":
-    Generate()
+    main()
@@ -0,0 +1,127 @@
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+
+from typing import Dict, List
+from reportlab.pdfgen.canvas import Canvas
+
+from config import PageConfig
+from tools import file_hash
+
+log = logging.getLogger(__name__)
+
+
+class IncrementalBuild:
+    """Keeps track of which students were rendered on which page of the
+    previous output, so that pages with unchanged students can be copied
+    from it instead of being rendered again.
+
+    Every student gets a fingerprint of the CSV row and of the photo contents,
+    every page a fingerprint of the render settings and of its students.
+    Copying pages needs the optional pypdf package, without it all pages
+    are rendered again."""
+
+    def __init__(self, manifest_path: os.path, params: tuple) -> None:
+        self.manifest_path = manifest_path
+        self.params = repr(params)
+        self.previous = self.load()
+
+    def load(self) -> dict:
+        if not os.path.exists(self.manifest_path):
+            return {"output": None, "output_hash": None, "pages": [], "slots": {}}
+        with open(self.manifest_path, "r") as f:
+            return json.load(f)
+
+    def student_fingerprint(self, student, img_path: os.path = None) -> str:
+        digest = hashlib.sha256()
+        # Section and university are shared by all students, not fields
+        for field in (*dataclasses.astuple(student), student.section,
+                      student.university):
+            digest.update(str(field).encode())
+            digest.update(b"\x1f")
+        if img_path is not None:
+            digest.update(file_hash(img_path).encode())
+        return digest.hexdigest()
+
+    def page_fingerprint(self, fingerprints: List[str]) -> str:
+        digest = hashlib.sha256(self.params.encode())
+        for fingerprint in fingerprints:
+            digest.update(fingerprint.encode())
+        return digest.hexdigest()
+
+    def is_known(self, fingerprint: str) -> bool:
+        """Whether the student was rendered in the previous output."""
+        return fingerprint in self.previous["slots"]
+
+    def reusable_pages(self, page_fingerprints: List[str]) -> Dict[int, int]:
+        """Maps indexes of pages that are the same as in the previous output
+        to their index in the previous output."""
+        previous_output = self.previous["output"]
+        if not previous_output or not os.path.exists(previous_output):
+            return {}
+        # The output may have been overwritten since, e.g. by a run without
+        # --incremental or of the other mode with the same output path
+        if file_hash(previous_output) != self.previous.get("output_hash"):
+            log.warning(f"'{previous_output}' changed since the last incremental run, "
+                        f"rendering all pages again")
+            return {}
+        try:
+            import pypdf  # noqa: F401
+        except ImportError:
+            log.warning("Install pypdf to reuse pages from the previous output, "
+                        "rendering all pages again")
+            return {}
+
+        previous = {fp: idx for idx, fp in enumerate(self.previous["pages"])}
+        return {idx: previous[fp] for idx, fp in enumerate(page_fingerprints)
+                if fp in previous}
+
+    def assemble(self, output_path: os.path, num_pages: int,
+                 reused: Dict[int, int], rendered_path: os.path) -> None:
+        """Writes the output from pages reused from the previous output
+        and pages newly rendered to rendered_path, in the right order."""
+        if num_pages == 0:
+            # Nothing was rendered to rendered_path, the output is an empty PDF
+            log.info("No students, writing an empty output")
+            Canvas(output_path, pagesize=PageConfig.page_size).save()
+            return
+        if not reused:
+            os.replace(rendered_path, output_path)
+            return
+
+        from pypdf import PdfReader, PdfWriter
+        writer = PdfWriter()
+        previous = PdfReader(self.previous["output"])
+        rendered = PdfReader(rendered_path) if len(reused) < num_pages else None
+        rendered_pages = iter(rendered.pages) if rendered is not None else None
+        for idx in range(num_pages):
+            if idx in reused:
+                writer.add_page(previous.pages[reused[idx]])
+            else:
+                writer.add_page(next(rendered_pages))
+
+        # The output may be the same file as the previous output
+        tmp_path = f"{output_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            writer.write(f)
+        os.replace(tmp_path, output_path)
+        if rendered is not None:
+            os.remove(rendered_path)
+
+    def save(self, output_path: os.path, page_fingerprints: List[str],
+             pages: List[List[str]]) -> None:
+        """Saves where each student was rendered, pages are lists
+        of student fingerprints in the order of slots."""
+        slots = {fp: [page_idx, slot]
+                 for page_idx, page in enumerate(pages)
+                 for slot, fp in enumerate(page)}
+        manifest = {
+            "output": os.path.abspath(output_path),
+            "output_hash": file_hash(output_path),
+            "pages": page_fingerprints,
+            "slots": slots,
+        }
+        with open(self.manifest_path, "w") as f:
+            json.dump(manifest, f, indent=1)
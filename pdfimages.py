@@ -0,0 +1,80 @@
+import hashlib
+import threading
+
+from contextlib import contextmanager
+from io import BytesIO
+from reportlab import rl_config
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus import Flowable
+
+from config import PageConfig
+
+
+# The reportlab settings are process wide, they are changed while at least
+# one PDF of this package is drawn and restored when the last one is done
+_settings_lock = threading.Lock()
+_settings_users = 0
+_saved_settings = dict()
+
+
+@contextmanager
+def pdf_settings():
+    """Applies the reportlab settings of PageConfig while a PDF is drawn and
+    saved. reportlab reads them when images and pages are written, so the
+    context has to cover both, other PDFs of the process keep their settings."""
+    global _settings_users
+    with _settings_lock:
+        if not _settings_users:
+            _saved_settings["useA85"] = rl_config.useA85
+        _settings_users += 1
+        rl_config.useA85 = int(PageConfig.ascii85)
+    try:
+        yield
+    finally:
+        with _settings_lock:
+            _settings_users -= 1
+            if not _settings_users:
+                rl_config.useA85 = _saved_settings.pop("useA85")
+
+
+def draw_image(canvas: Canvas, img: BytesIO, x: float, y: float,
+               width: float, height: float) -> None:
+    """Draws a JPEG photo, embedding every distinct photo only once per PDF.
+
+    reportlab reuses identical images as well, but it recognizes them by
+    the decoded pixels, so it decodes every copy again. Here the photo is
+    wrapped in a form named by the hash of the JPEG bytes and a repeated
+    photo only references the form."""
+    if not PageConfig.deduplicate_images:
+        canvas.drawImage(ImageReader(img), x, y, width=width, height=height)
+        return
+
+    # The name is repeated in the resources of every page that uses it
+    name = f"photo-{hashlib.sha256(img.getbuffer()).hexdigest()[:20]}-{width:.0f}x{height:.0f}"
+    if not canvas.hasForm(name):
+        # The bounding box clips the form, a point of margin keeps viewers
+        # from cutting off partially covered pixels at the edges
+        canvas.beginForm(name, -1, -1, width + 1, height + 1)
+        canvas.drawImage(ImageReader(img), 0, 0, width=width, height=height)
+        canvas.endForm()
+    canvas.saveState()
+    canvas.translate(x, y)
+    canvas.doForm(name)
+    canvas.restoreState()
+
+
+class Photo(Flowable):
+    """Platypus counterpart of draw_image, used instead of Image in tables."""
+
+    def __init__(self, img: BytesIO, width: float, height: float) -> None:
+        super().__init__()
+        self.img = img
+        self.width = width
+        self.height = height
+
+    def wrap(self, availWidth: float, availHeight: float) -> tuple:
+        return self.width, self.height
+
+    def draw(self) -> None:
+        draw_image(self.canv, self.img, 0, 0, self.width, self.height)
@@ -0,0 +1,98 @@
+import os
+
+from typing import BinaryIO, Dict, List
+
+# The catalog and the page tree of the output, the objects of the parts
+# are numbered after them
+CATALOG = 1
+PAGES = 2
+
+
+class PdfConcatenation:
+    """Writes the pages of several PDFs into one file. Only the part that
+    is being copied is kept in memory, the objects are written as soon as
+    they are renumbered, unlike pypdf's PdfWriter which keeps the whole
+    output until it is written."""
+
+    def __init__(self, out: BinaryIO) -> None:
+        self.out = out
+        self.offsets = dict()
+        self.kids = list()
+        self.next_number = PAGES + 1
+        self.out.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def write_object(self, number: int, obj) -> None:
+        self.offsets[number] = self.out.tell()
+        self.out.write(f"{number} 0 obj\n".encode())
+        obj.write_to_stream(self.out)
+        self.out.write(b"\nendobj\n")
+
+    def renumber(self, obj, numbers: Dict[int, int], pending: List):
+        """Replaces the references of the part with the numbers of the output,
+        referenced objects that were not numbered yet are added to pending."""
+        from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject
+
+        if isinstance(obj, IndirectObject):
+            if obj.idnum not in numbers:
+                numbers[obj.idnum] = self.next_number
+                self.next_number += 1
+                pending.append(obj)
+            return IndirectObject(numbers[obj.idnum], 0, None)
+        # The raw items, the getters of pypdf resolve the references
+        if isinstance(obj, DictionaryObject):
+            for key, value in list(dict.items(obj)):
+                dict.__setitem__(obj, key, self.renumber(value, numbers, pending))
+        elif isinstance(obj, ArrayObject):
+            for idx, value in enumerate(list(list.__iter__(obj))):
+                list.__setitem__(obj, idx, self.renumber(value, numbers, pending))
+        return obj
+
+    def append(self, part_path: os.path) -> None:
+        """Copies all pages of the part with the objects they use."""
+        from pypdf import PdfReader
+        from pypdf.generic import IndirectObject, NameObject
+
+        reader = PdfReader(part_path)
+        # Object numbers of the part mapped to the numbers in the output
+        numbers = dict()
+        pending = list()
+        for page in reader.pages:
+            self.kids.append(self.renumber(page.indirect_reference, numbers, pending))
+        while pending:
+            ref = pending.pop()
+            obj = reader.get_object(ref)
+            if obj.get("/Type") == "/Page":
+                # The page tree of the part is not copied
+                dict.__setitem__(obj, NameObject("/Parent"),
+                                 IndirectObject(PAGES, 0, None))
+            self.write_object(numbers[ref.idnum], self.renumber(obj, numbers, pending))
+
+    def close(self) -> None:
+        """Writes the page tree, the catalog and the cross-reference table."""
+        from pypdf.generic import (ArrayObject, DictionaryObject, NameObject,
+                                   NumberObject, IndirectObject)
+
+        self.write_object(PAGES, DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): ArrayObject(self.kids),
+            NameObject("/Count"): NumberObject(len(self.kids)),
+        }))
+        self.write_object(CATALOG, DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): IndirectObject(PAGES, 0, None),
+        }))
+        xref = self.out.tell()
+        self.out.write(f"xref\n0 {self.next_number}\n0000000000 65535 f \n".encode())
+        for number in range(1, self.next_number):
+            self.out.write(f"{self.offsets[number]:010d} 00000 n \n".encode())
+        self.out.write(f"trailer\n<< /Size {self.next_number} /Root {CATALOG} 0 R >>\n"
+                       f"startxref\n{xref}\n%%EOF\n".encode())
+
+
+def concatenate(part_paths: List[os.path], output_path: os.path) -> None:
+    """Writes the pages of the parts in their order into output_path."""
+    with open(output_path, "wb") as out:
+        concatenation = PdfConcatenation(out)
+        for part_path in part_paths:
+            concatenation.append(part_path)
+        concatenation.close()
@@ -0,0 +1,168 @@
+import argparse
+import logging
+import os
+import queue
+import threading
+import time
+
+from datetime import datetime
+from typing import Iterable, Iterator
+
+from config import Config, PrintMode
+from download_images import DownloadImages
+from generate import (Generate, StudentInfo, add_detector_arguments,
+                      check_detector_arguments, default_output_path)
+from profiler import profiler, report as profile_report
+
+log = logging.getLogger(__name__)
+
+# Marks the end of the stream in the queues between the stages
+DONE = None
+
+
+class Pipeline(DownloadImages):
+    """Runs the whole toolchain from the form export to both PDFs in one pass.
+    Students flow through three stages connected by bounded queues: downloads
+    in the thread pool of DownloadImages, cropping of the photos a page at
+    a time, and drawing of the text and photo pages. Photos of the first page
+    are cropped while the later ones are still downloading."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.generate = Generate(args)
+        date = datetime.now()
+        self.text_path = default_output_path(PrintMode.TEXT_ONLY, date)
+        self.photo_path = default_output_path(PrintMode.PHOTO_ONLY, date)
+        self.text_layout = self.generate.text_layout(self.text_path)
+        self.photo_layout = self.generate.photo_layout(self.photo_path)
+        self.downloaded = queue.Queue(maxsize=args.queue_size)
+        self.cropped = queue.Queue(maxsize=args.queue_size)
+        self.exhausted = set()
+        self.errors = list()
+
+        self.generate.import_legacy_decisions()
+        stages = [
+            threading.Thread(target=self.run_stage,
+                             args=(self.crop_photos, self.downloaded, self.cropped)),
+            threading.Thread(target=self.run_stage,
+                             args=(self.draw_pages, self.cropped, None)),
+        ]
+        for stage in stages:
+            stage.start()
+        try:
+            super().__init__(args.csv_file, args.download_workers,
+                             args.resume, args.validate)
+        finally:
+            self.downloaded.put(DONE)
+            for stage in stages:
+                stage.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def row_finished(self, row: list, downloaded: bool) -> list:
+        """Passes the downloaded students to the next stage in the input order."""
+        self.downloaded.put(StudentInfo(*row))
+        return row
+
+    def items(self, source: queue.Queue) -> Iterator:
+        """Items of the queue until the end of the stream."""
+        while source not in self.exhausted:
+            item = source.get()
+            if item is DONE:
+                self.exhausted.add(source)
+                return
+            yield item
+
+    def run_stage(self, stage, source: queue.Queue, sink: queue.Queue) -> None:
+        try:
+            stage(self.items(source), sink)
+        except Exception as e:
+            log.exception(f"Stage {stage.__name__} failed")
+            self.errors.append(e)
+            # Keep taking items, so the previous stage never blocks on a full queue
+            for _ in self.items(source):
+                pass
+        finally:
+            if sink is not None:
+                sink.put(DONE)
+
+    def crop_photos(self, students: Iterable[StudentInfo], sink: queue.Queue) -> None:
+        """Crops the photos a page at a time, so the detection processes are
+        kept busy, students without a picture are passed on without a photo."""
+        detector = self.generate.detector
+        executor = None
+        if self.args.workers > 1:
+            executor = detector.create_pool(self.args.workers)
+        try:
+            for page in self.photo_layout.paginate(students):
+                printable = [student for student in page
+                             if os.path.exists(student.img_destination)]
+                with profiler.stage("crop_photos"):
+                    crops = dict(zip(
+                        (student.img_destination for student in printable),
+                        detector.run_many([student.img_destination for student in printable],
+                                          executor=executor)))
+                for student in page:
+                    if student.img_destination not in crops:
+                        log.warning(f"{student.name} has no picture, "
+                                    f"leaving them out of the photo PDF")
+                    sink.put((student, crops.get(student.img_destination)))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def draw_pages(self, blocks: Iterable[tuple], sink: queue.Queue) -> None:
+        """Draws a page of the text and of the photo PDF as soon as it is full."""
+        text_layout, photo_layout = self.text_layout, self.photo_layout
+        text_page, photo_page = list(), list()
+        for student, crop in blocks:
+            text_page.append(student)
+            if crop is not None:
+                photo_page.append((student, crop))
+            if len(text_page) == text_layout.page_size:
+                text_layout.draw_page(text_page, self.generate.draw_text_block)
+                text_page = list()
+            if len(photo_page) == photo_layout.page_size:
+                photo_layout.draw_page(photo_page, self.generate.draw_photo_block)
+                photo_page = list()
+
+        if text_page:
+            text_layout.draw_page(text_page, self.generate.draw_text_block)
+        if photo_page:
+            photo_layout.draw_page(photo_page, self.generate.draw_photo_block)
+        text_layout.save()
+        photo_layout.save()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Downloads the photos and creates the text and photo PDFs in one run.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('csv_file',
+                        help='CSV file exported from the application form.')
+    parser.add_argument('--download-workers', type=int,
+                        default=Config.download_workers,
+                        help='Number of concurrent downloads.')
+    parser.add_argument('--resume', action="store_true",
+                        help='Record progress of the downloads in a manifest and '
+                             'continue an interrupted run.')
+    parser.add_argument('--validate', action="store_true",
+                        help='Download only new or changed pictures, implies --resume.')
+    parser.add_argument('--queue-size', type=int,
+                        default=Config.pipeline_queue_size,
+                        help='Number of students waiting between two stages.')
+    add_detector_arguments(parser)
+    args = parser.parse_args()
+    check_detector_arguments(parser, args)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.profile:
+        profiler.enable(args.profile_dump)
+    start = time.perf_counter()
+    pipeline = Pipeline(args)
+    log.info(f"Created {pipeline.text_path} and {pipeline.photo_path} "
+             f"in {time.perf_counter() - start:.2f}s")
+    profile_report(args.profile_top, args.profile_dump)
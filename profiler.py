@@ -0,0 +1,126 @@
+import cProfile
+import os
+import resource
+import threading
+import time
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+
+class Profiler:
+    """Records wall and CPU time of the stages of a run, per stage and per item
+    (e.g. a photo), together with counters like cache hits. It does nothing
+    until enabled, so the instrumented code pays almost nothing by default."""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.records = list()
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._cprofile = None
+
+    def enable(self, dump_path: os.path = None) -> None:
+        self.enabled = True
+        if dump_path:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    @contextmanager
+    def stage(self, name: str, item: str = None):
+        """Measures the enclosed block as one call of the stage.
+        CPU time is measured for the current thread only."""
+        if not self.enabled:
+            yield
+            return
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            record = (name, item, time.perf_counter() - wall,
+                      time.thread_time() - cpu)
+            with self._lock:
+                self.records.append(record)
+
+    def count(self, name: str, value: int = 1) -> None:
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += value
+
+    def drain(self) -> tuple:
+        """Returns and forgets everything recorded so far, used to send
+        the measurements from worker processes to the main one."""
+        with self._lock:
+            records, counters = self.records, self.counters
+            self.records, self.counters = list(), Counter()
+        return records, counters
+
+    def merge(self, data: tuple) -> None:
+        records, counters = data
+        with self._lock:
+            self.records.extend(records)
+            self.counters.update(counters)
+
+    def peak_memory(self) -> dict:
+        """Peak RSS in MB of this process and of the finished worker processes."""
+        # ru_maxrss is in kB on Linux
+        return {
+            "main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        }
+
+    def summary(self, top: int = 10) -> str:
+        """Table with totals of each stage, the counters, peak memory
+        and the top slowest items."""
+        stages = defaultdict(lambda: [0, 0.0, 0.0])
+        items = defaultdict(float)
+        for name, item, wall, cpu in self.records:
+            stage = stages[name]
+            stage[0] += 1
+            stage[1] += wall
+            stage[2] += cpu
+            if item is not None:
+                items[item] += wall
+
+        lines = [f"{'stage':<20} {'calls':>7} {'wall [s]':>10} {'cpu [s]':>10} {'mean [ms]':>10}"]
+        for name, (calls, wall, cpu) in stages.items():
+            lines.append(f"{name:<20} {calls:>7} {wall:>10.3f} {cpu:>10.3f} "
+                         f"{wall / calls * 1000:>10.1f}")
+
+        if self.counters:
+            lines.append("")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"{name:<20} {value:>7}")
+
+        memory = self.peak_memory()
+        lines.append("")
+        lines.append(f"peak memory: {memory['main']:.1f} MB, "
+                     f"workers {memory['workers']:.1f} MB")
+
+        if items:
+            lines.append("")
+            lines.append(f"{top} slowest items:")
+            slowest = sorted(items.items(), key=lambda kv: kv[1], reverse=True)
+            for item, wall in slowest[:top]:
+                lines.append(f"{wall:>10.3f} s  {item}")
+        return "\n".join(lines)
+
+    def dump(self, dump_path: os.path) -> None:
+        """Writes the cProfile statistics, open them with pstats or snakeviz."""
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(dump_path)
+
+
+# Profiler shared by all modules of the process
+profiler = Profiler()
+
+
+def report(top: int, dump_path: os.path = None) -> None:
+    """Prints the summary and writes the cProfile dump if requested."""
+    if not profiler.enabled:
+        return
+    print(profiler.summary(top))
+    if dump_path:
+        profiler.dump(dump_path)
+        print(f"cProfile statistics saved to {dump_path}")
@@ -0,0 +1,160 @@
+import argparse
+import html
+import logging
+import os
+import threading
+import webbrowser
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from config import Config
+from decisionstore import DecisionStore
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+THUMBNAIL_SIZE = 200
+
+
+class Review:
+    """Shows all photos queued with --queue-review on one page in the browser,
+    with the detected faces side by side. The choices are saved to the decision
+    store at once, the next run of generate.py uses them."""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.store = DecisionStore()
+        self.queued = self.store.queued()
+        self.review_path = Config.review_path
+        self.port = args.port
+        self.open_browser = not args.no_browser
+
+    def thumbnail_name(self, img_hash: str, idx: int) -> str:
+        return f"{img_hash}-{idx}.jpg"
+
+    def write_thumbnails(self) -> None:
+        """Writes thumbnails of the faces. Photos that were moved, deleted
+        or cannot be read are left out of the review."""
+        from PIL import Image, ImageOps
+
+        os.makedirs(self.review_path, exist_ok=True)
+        readable = list()
+        for img_hash, img_path, rects in self.queued:
+            try:
+                with Image.open(img_path) as img:
+                    # The rectangles are in the coordinates of the transposed image
+                    img = ImageOps.exif_transpose(img)
+                    for idx, rect in enumerate(rects):
+                        face = img.crop(rect).convert("RGB")
+                        face.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+                        face.save(os.path.join(self.review_path,
+                                               self.thumbnail_name(img_hash, idx)))
+            except OSError as e:
+                log.warning(f"Skipping '{img_path}', it cannot be read: {e}")
+                continue
+            readable.append((img_hash, img_path, rects))
+        self.queued = readable
+
+    def page(self) -> bytes:
+        rows = list()
+        for img_hash, img_path, rects in self.queued:
+            choices = [f'<label><input type="radio" name="{img_hash}" value="skip" checked>'
+                       f'skip</label>']
+            for idx in range(len(rects)):
+                choices.append(
+                    f'<label><input type="radio" name="{img_hash}" value="{idx}">'
+                    f'<img src="/thumbnails/{self.thumbnail_name(img_hash, idx)}"></label>')
+            rows.append(f'<fieldset><legend>{html.escape(img_path)}</legend>'
+                        f'{"".join(choices)}</fieldset>')
+        return (f'<!DOCTYPE html><html><head><meta charset="utf-8">'
+                f'<title>Review of {len(self.queued)} photos</title>'
+                f'<style>img {{vertical-align: middle; margin: 4px}}</style></head>'
+                f'<body><h1>Choose the face of the student</h1>'
+                f'<form method="post">{"".join(rows)}'
+                f'<p><button type="submit">Save decisions</button></p>'
+                f'</form></body></html>').encode()
+
+    def save(self, choices: dict) -> int:
+        """Stores the chosen faces, skipped photos stay in the queue."""
+        saved = 0
+        for img_hash, _, rects in self.queued:
+            choice = choices.get(img_hash, ["skip"])[0]
+            if choice == "skip":
+                continue
+            self.store.put(img_hash, rects[int(choice)])
+            saved += 1
+        log.info(f"Saved {saved} decisions, {len(self.queued) - saved} photos stay queued")
+        return saved
+
+    def handler(self):
+        review = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/":
+                    self.respond(review.page(), "text/html; charset=utf-8")
+                elif self.path.startswith("/thumbnails/"):
+                    name = os.path.basename(self.path)
+                    thumbnail_path = os.path.join(review.review_path, name)
+                    if not os.path.isfile(thumbnail_path):
+                        self.send_error(404)
+                        return
+                    with open(thumbnail_path, "rb") as f:
+                        self.respond(f.read(), "image/jpeg")
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                choices = parse_qs(self.rfile.read(length).decode())
+                saved = review.save(choices)
+                self.respond(f"Saved {saved} decisions, you can close this page."
+                             .encode(), "text/plain; charset=utf-8")
+                # shutdown() waits for serve_forever, which runs this handler
+                threading.Thread(target=self.server.shutdown).start()
+
+            def respond(self, body: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        return Handler
+
+    def run(self) -> None:
+        if not self.queued:
+            log.info("No photos are waiting for the review")
+            return
+        self.write_thumbnails()
+        if not self.queued:
+            log.info("None of the queued photos can be read")
+            return
+        server = ThreadingHTTPServer(("127.0.0.1", self.port), self.handler())
+        url = f"http://127.0.0.1:{server.server_port}/"
+        log.info(f"Review {len(self.queued)} photos at {url}")
+        if self.open_browser:
+            webbrowser.open(url)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.store.close()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Review of photos with multiple faces queued by --queue-review.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--port', type=int, default=Config.review_port,
+                        help='Port of the review page on localhost.')
+    parser.add_argument('--no-browser', action="store_true",
+                        help='Only print the address of the review page.')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    Review(parse_arguments()).run()
@@ -0,0 +1,210 @@
+import argparse
+import csv
+import json
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from typing import List
+
+from PIL import UnidentifiedImageError
+
+from config import Config, PrintMode
+from facedetector import Placeholder
+from generate import (Generate, StudentInfo, add_detector_arguments,
+                      check_detector_arguments, validate_rows)
+from profiler import profiler, report as profile_report
+
+log = logging.getLogger(__name__)
+
+# Keys of the students in JSON requests, in the order of the students.csv columns
+STUDENT_KEYS = ["name", "date_of_birth", "nationality", "today", "img_destination"]
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class Conflict(RuntimeError):
+    """The photos are queued for review.py, the cards cannot be printed yet."""
+    pass
+
+
+class Service:
+    """Local HTTP service rendering the text or photo PDF of a few students
+    on demand. The fonts, the face detector with its cascade and the crop
+    cache stay loaded between requests, which are rendered concurrently
+    by a bounded pool of threads.
+
+    POST /text or /photo with a JSON list of students, objects with the keys
+    of STUDENT_KEYS (today is optional), or with rows of students.csv
+    as text/csv. The response is the PDF. Photos have to be in Config.imgpath,
+    photos with several faces that are waiting for review.py are listed
+    in a 409 response."""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        # Nobody can answer a prompt, undecided photos are queued for review.py
+        args.queue_review = True
+        self.generate = Generate(args)
+        # The cascade and the crop cache are loaded once, before the first request
+        self.detector = self.generate.detector
+        self.pool = ThreadPoolExecutor(args.service_workers)
+
+    def parse_students(self, body: bytes, content_type: str) -> List[List[str]]:
+        """Rows of students.csv from the request body."""
+        try:
+            text = body.decode()
+        except UnicodeDecodeError:
+            raise BadRequest("The request body is not UTF-8")
+        if content_type.startswith("text/csv"):
+            return list(csv.reader(StringIO(text, newline="")))
+        if not content_type.startswith("application/json"):
+            raise BadRequest("Send the students as application/json or text/csv")
+
+        try:
+            students = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise BadRequest(f"Invalid JSON: {e}")
+        if not isinstance(students, list):
+            raise BadRequest("Expected a JSON list of students")
+        today = datetime.now().strftime(Config.card_date_format)
+        rows = list()
+        for idx, student in enumerate(students, 1):
+            if not isinstance(student, dict):
+                raise BadRequest(f"Student {idx} is not a JSON object")
+            student = {"today": today, "img_destination": "", **student}
+            missing = [key for key in STUDENT_KEYS if key not in student]
+            if missing:
+                raise BadRequest(f"Student {idx} is missing {', '.join(missing)}")
+            rows.append([str(student[key]) for key in STUDENT_KEYS])
+        return rows
+
+    def check_photos(self, rows: List[List[str]]) -> None:
+        """Only photos in Config.imgpath can be requested, anything else on
+        the machine would be readable by the clients."""
+        imgpath = os.path.realpath(Config.imgpath)
+        outside = [row[4] for row in rows if len(row) == len(STUDENT_KEYS) and
+                   os.path.commonpath([imgpath, os.path.realpath(row[4])]) != imgpath]
+        if outside:
+            raise BadRequest(f"Photos have to be in '{Config.imgpath}': {', '.join(outside)}")
+
+    def render(self, mode: PrintMode, rows: List[List[str]]) -> bytes:
+        """Validates the students and renders their PDF, runs in the pool."""
+        if mode == PrintMode.PHOTO_ONLY:
+            self.check_photos(rows)
+        errors = validate_rows(rows, mode == PrintMode.PHOTO_ONLY)
+        if errors:
+            raise BadRequest("\n".join(errors))
+        students = [StudentInfo(*row) for row in rows]
+
+        output = BytesIO()
+        if mode == PrintMode.TEXT_ONLY:
+            layout = self.generate.text_layout(output)
+            layout.render(students, self.generate.draw_text_block)
+        else:
+            # The threads of the pool are the parallelism, no worker processes
+            with profiler.stage("crop_photos"):
+                try:
+                    crops = self.detector.run_many(
+                        [student.img_destination for student in students])
+                except (UnidentifiedImageError, OSError) as e:
+                    raise BadRequest(f"Cannot read the photo: {e}")
+            queued = [student.img_destination
+                      for student, crop in zip(students, crops)
+                      if isinstance(crop, Placeholder)]
+            if queued:
+                raise Conflict("Photos with several faces are queued, choose the faces "
+                               "with review.py and send the request again:\n"
+                               + "\n".join(queued))
+            layout = self.generate.photo_layout(output)
+            layout.render(zip(students, crops), self.generate.draw_photo_block)
+        return output.getvalue()
+
+    def handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    mode = PrintMode(self.path.strip("/"))
+                except ValueError:
+                    self.send_error(404, "Use /text or /photo")
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                if length > Config.service_max_body:
+                    self.send_error(413)
+                    return
+                body = self.rfile.read(length)
+                try:
+                    rows = service.parse_students(
+                        body, self.headers.get("Content-Type", ""))
+                    pdf = service.pool.submit(service.render, mode, rows).result()
+                except BadRequest as e:
+                    self.respond(400, str(e).encode(), "text/plain; charset=utf-8")
+                    return
+                except Conflict as e:
+                    self.respond(409, str(e).encode(), "text/plain; charset=utf-8")
+                    return
+                except Exception:
+                    log.exception(f"Rendering of {self.path} failed")
+                    self.send_error(500)
+                    return
+                log.info(f"Rendered {mode} PDF of {len(rows)} students "
+                         f"for {self.client_address[0]}")
+                self.respond(200, pdf, "application/pdf")
+
+            def respond(self, status: int, body: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        return Handler
+
+    def create_server(self) -> ThreadingHTTPServer:
+        """The server is returned unstarted, port 0 picks a free port."""
+        return ThreadingHTTPServer((self.args.host, self.args.port), self.handler())
+
+    def run(self) -> None:
+        server = self.create_server()
+        log.info(f"Rendering cards at http://{self.args.host}:{server.server_port}/")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.pool.shutdown()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Local HTTP service rendering the cards of a few students on demand.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', default=Config.service_host,
+                        help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=Config.service_port,
+                        help='Port to listen on.')
+    parser.add_argument('--service-workers', type=int, default=Config.service_workers,
+                        help='Number of requests rendered at the same time.')
+    add_detector_arguments(parser)
+    args = parser.parse_args()
+    check_detector_arguments(parser, args)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.profile:
+        profiler.enable(args.profile_dump)
+    try:
+        Service(args).run()
+    except KeyboardInterrupt:
+        log.info("Stopped the service")
+    profile_report(args.profile_top, args.profile_dump)
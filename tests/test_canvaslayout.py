@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from canvaslayout import CanvasLayout  # noqa: E402
+
+pypdf = pytest.importorskip("pypdf")
+
+
+def draw_number(canvas, x: float, y: float, number: int) -> None:
+    canvas.drawString(x + 5, y + 5, f"card {number}")
+
+
+@pytest.mark.parametrize("num_cards", [0, 1, 4, 5, 9])
+def test_chunk_pages(tmp_path, num_cards):
+    """The parts are joined into one PDF with the pages in their order."""
+    output_path = str(tmp_path / "output.pdf")
+    layout = CanvasLayout(output_path, num_columns=1, col_width=100,
+                          row_height=100, chunk_pages=2)
+    layout.num_rows = 1
+    layout.render(range(num_cards), draw_number)
+
+    reader = pypdf.PdfReader(output_path)
+    assert [page.extract_text().strip() for page in reader.pages] == [
+        f"card {number}" for number in range(num_cards)]
+    assert os.listdir(tmp_path) == ["output.pdf"]
@@ -0,0 +1,156 @@
+import csv
+import os
+import struct
+import sys
+import threading
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import download_images  # noqa: E402
+from download_images import DownloadImages  # noqa: E402
+from downloadmanifest import DownloadManifest  # noqa: E402
+
+
+def jpeg() -> bytes:
+    buf = BytesIO()
+    Image.new("RGB", (60, 80), (200, 150, 100)).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def decompression_bomb() -> bytes:
+    """PNG with a header of a 20000x20000 image, PIL refuses to open it."""
+    buf = BytesIO()
+    Image.new("1", (1, 1)).save(buf, "PNG")
+    data = bytearray(buf.getvalue())
+    data[16:24] = struct.pack(">II", 20000, 20000)
+    data[29:33] = struct.pack(">I", zlib.crc32(bytes(data[12:29])))
+    return bytes(data)
+
+
+@pytest.fixture(scope="module")
+def drive():
+    """Stand-in for the Drive API with the files "photo" and "bomb",
+    anything else is a 404."""
+    data = jpeg()
+    files = {"photo": ("image/jpeg", data), "bomb": ("image/png", decompression_bomb())}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            file_id = self.path.split("/files/")[1].split("?")[0]
+            if file_id not in files:
+                self.send_error(404)
+                return
+            content_type, body = files[file_id]
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", data
+    server.shutdown()
+    server.server_close()
+
+
+def download(drive_url: str, folder, rows: list, **kwargs) -> DownloadImages:
+    """Runs DownloadImages in folder on a form export with the given
+    (name, date of birth, file ID) rows."""
+
+    class LocalDownload(DownloadImages):
+        DRIVE_URL = drive_url
+
+        def authenticate(self, *args):
+            self.credentials = type("Credentials", (), {"token": "offline", "valid": True})
+
+        def download_file(self, file_id: str, destination: str) -> str:
+            if file_id == "crash":
+                raise RuntimeError("Unexpected error")
+            return super().download_file(file_id, destination)
+
+    csv_path = os.path.join(folder, "form.csv")
+    with open(csv_path, "w") as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(["Timestamp", "Name", "Country", "Date of Birth", "Photo"])
+        for name, date_of_birth, file_id in rows:
+            csv_writer.writerow(["2024-09-01", name, "czech", date_of_birth,
+                                 f"https://drive.google.com/open?id={file_id}"])
+    os.makedirs(os.path.join(folder, "pictures"), exist_ok=True)
+    return LocalDownload(csv_path, workers=2, **kwargs)
+
+
+def read_students(folder) -> list:
+    with open(os.path.join(folder, "students.csv")) as f:
+        return list(csv.reader(f))
+
+
+def test_download(drive, tmp_path, monkeypatch):
+    url, data = drive
+    monkeypatch.chdir(tmp_path)
+    downloader = download(url, tmp_path, [("Walter White", "09/07/1998", "photo")])
+    with open(tmp_path / "pictures" / "Walter White.jpg", "rb") as f:
+        assert f.read() == data
+    assert downloader.failed == []
+    [row] = read_students(tmp_path)
+    assert row[0] == "Walter White"
+    assert row[4] == str(tmp_path / "pictures" / "Walter White.jpg")
+
+
+def test_missing_file(drive, tmp_path, monkeypatch):
+    """A 404, an invalid row and an unexpected error fail only their rows."""
+    url, _ = drive
+    monkeypatch.chdir(tmp_path)
+    downloader = download(url, tmp_path, [
+        ("Walter White", "09/07/1998", "photo"),
+        ("Jesse Pinkman", "09/24/1984", "missing"),
+        ("Saul Goodman", "1960-11-12", "photo"),
+        ("Gus Fring", "04/10/1958", "crash"),
+    ])
+    # The downloads finish in any order
+    assert sorted(downloader.failed) == [("Gus Fring", "file ID crash"),
+                                         ("Jesse Pinkman", "file ID missing"),
+                                         ("Saul Goodman", "invalid row")]
+    assert os.listdir(tmp_path / "pictures") == ["Walter White.jpg"]
+    assert [row[0] for row in read_students(tmp_path)] == [
+        "Walter White", "Jesse Pinkman", "Gus Fring"]
+
+
+def test_conversion_failure(drive, tmp_path, monkeypatch):
+    """A photo the converter cannot decode fails only its row."""
+    url, _ = drive
+    monkeypatch.chdir(tmp_path)
+    downloader = download(url, tmp_path, [("Walter White", "09/07/1998", "bomb"),
+                                          ("Jesse Pinkman", "09/24/1984", "photo")])
+    assert downloader.failed == [("Walter White", "file ID bomb")]
+    assert os.listdir(tmp_path / "pictures") == ["Jesse Pinkman.jpg"]
+
+
+def test_resume(drive, tmp_path, monkeypatch):
+    """Failed pictures are downloaded again by the next run."""
+    url, _ = drive
+    monkeypatch.chdir(tmp_path)
+
+    class Manifest(DownloadManifest):
+        def __init__(self):
+            super().__init__(str(tmp_path / "pictures" / "manifest.jsonl"))
+
+    monkeypatch.setattr(download_images, "DownloadManifest", Manifest)
+    download(url, tmp_path, [("Walter White", "09/07/1998", "missing")], resume=True)
+    assert not os.path.exists(tmp_path / "pictures" / "Walter White.jpg")
+    downloader = download(url, tmp_path, [("Walter White", "09/07/1998", "photo")],
+                          resume=True)
+    assert downloader.failed == []
+    assert os.path.exists(tmp_path / "pictures" / "Walter White.jpg")
+    assert [row[0] for row in read_students(tmp_path)] == ["Walter White"]
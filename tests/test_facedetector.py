@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from config import Config  # noqa: E402
+from facedetector import FaceDetector, intersection_over_union  # noqa: E402
+
+# Portrait of astronaut Eileen Collins (NASA, public domain), 800x800 px
+FACE_PATH = os.path.join(REPO_DIR, "tests", "data", "face.jpg")
+CASC_PATH = os.path.join(REPO_DIR, Config.casc_path)
+# Same tolerance as `benchmark.py scaling`
+MIN_IOU = 0.8
+
+
+@pytest.fixture(scope="module")
+def reference():
+    """Face found by the accurate preset at full resolution."""
+    _, rects, _ = FaceDetector(CASC_PATH, 0, "accurate").find_faces(FACE_PATH)
+    assert len(rects) == 1
+    return rects[0]
+
+
+@pytest.mark.parametrize("preset", ["accurate", "balanced", "fast"])
+@pytest.mark.parametrize("max_side", [0, 640, 400])
+def test_downscaled_detection(reference, preset, max_side):
+    """The expanded rectangle of the face found on a downscaled image or with
+    a faster preset is the one found at full resolution, in the coordinates
+    of the full resolution image."""
+    _, rects, _ = FaceDetector(CASC_PATH, max_side, preset).find_faces(FACE_PATH)
+    assert len(rects) >= 1
+    assert max(intersection_over_union(rect, reference) for rect in rects) >= MIN_IOU
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from generate import Generate, InvalidStudents  # noqa: E402
+
+
+def generate(monkeypatch, *args) -> Generate:
+    """Generate with the given command line, run from the repository
+    folder for the fonts."""
+    monkeypatch.chdir(REPO_DIR)
+    monkeypatch.setattr(sys, "argv", ["generate.py", *args])
+    return Generate()
+
+
+def test_invalid_students(monkeypatch, tmp_path):
+    """Bad rows are raised to the caller instead of exiting the process."""
+    csv_path = tmp_path / "students.csv"
+    csv_path.write_text("Walter White,1998-09-07,Mexico,17  10  26,\n"
+                        "Jesse Pinkman,24  09  84,USA\n")
+    output_path = tmp_path / "output.pdf"
+    with pytest.raises(InvalidStudents) as e:
+        generate(monkeypatch, "-m", "text", "-p", str(csv_path), "-o", str(output_path)).run()
+    assert len(e.value.errors) == 2
+    assert not output_path.exists()
+
+
+def test_text(monkeypatch, tmp_path):
+    csv_path = tmp_path / "students.csv"
+    csv_path.write_text("Walter White,07  09  98,Mexico,17  10  26,\n")
+    output_path = tmp_path / "output.pdf"
+    generate(monkeypatch, "-m", "text", "-p", str(csv_path), "-o", str(output_path)).run()
+    assert output_path.read_bytes().startswith(b"%PDF")
+
+
+def test_pdf_settings_restored(monkeypatch, tmp_path):
+    """The reportlab settings of PageConfig only apply to our own PDFs."""
+    from reportlab import rl_config
+    monkeypatch.setattr(rl_config, "useA85", 1)
+    csv_path = tmp_path / "students.csv"
+    csv_path.write_text("Walter White,07  09  98,Mexico,17  10  26,\n")
+    generate(monkeypatch, "-m", "text", "-p", str(csv_path),
+             "-o", str(tmp_path / "output.pdf")).run()
+    assert rl_config.useA85 == 1
+
+
+def test_profile_dump_enables_profiling(monkeypatch, tmp_path):
+    from profiler import profiler
+    dump_path = tmp_path / "profile.prof"
+    monkeypatch.setattr(profiler, "enabled", False)
+    monkeypatch.setattr(profiler, "records", list())
+    csv_path = tmp_path / "students.csv"
+    csv_path.write_text("Walter White,07  09  98,Mexico,17  10  26,\n")
+    generate(monkeypatch, "-m", "text", "-p", str(csv_path), "-o", str(tmp_path / "output.pdf"),
+             "--profile-dump", str(dump_path)).run()
+    assert dump_path.exists()
@@ -0,0 +1,145 @@
+import json
+import os
+import sys
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmark import synthetic_photo  # noqa: E402
+from config import Config  # noqa: E402
+from decisionstore import DecisionStore  # noqa: E402
+from service import Service, parse_arguments  # noqa: E402
+
+TODAY = "17  10  26"
+
+
+@pytest.fixture(scope="module")
+def pictures(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("pictures")
+    synthetic_photo(os.path.join(folder, "photo.jpg"), (600, 800), 0)
+    with open(os.path.join(folder, "broken.jpg"), "wb") as f:
+        f.write(b"not a JPEG")
+    return str(folder)
+
+
+@pytest.fixture(scope="module")
+def service(pictures):
+    """The service runs in this process on a free port, from the repository
+    folder for the fonts and the cascade, without the crop cache."""
+    cwd = os.getcwd()
+    argv = sys.argv
+    imgpath = Config.imgpath
+    os.chdir(REPO_DIR)
+    sys.argv = ["service.py", "--port", "0", "--no-cache", "--resolve-policy", "largest"]
+    Config.imgpath = pictures
+    service = Service(parse_arguments())
+    server = service.create_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield service, server.server_port
+    server.shutdown()
+    server.server_close()
+    service.pool.shutdown()
+    Config.imgpath = imgpath
+    sys.argv = argv
+    os.chdir(cwd)
+
+
+def post(service, path, body, content_type="application/json"):
+    """Returns the status and the body of the response."""
+    _, port = service
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+    req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=body,
+                                 headers={"Content-Type": content_type})
+    try:
+        with urllib.request.urlopen(req) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def student(**kwargs):
+    return {"name": "Walter White", "date_of_birth": "07  09  98",
+            "nationality": "Mexico", "today": TODAY, **kwargs}
+
+
+def test_text_json(service):
+    status, body = post(service, "/text", [student(), student(name="Jesse Pinkman")])
+    assert status == 200
+    assert body.startswith(b"%PDF")
+
+
+def test_text_csv(service):
+    status, body = post(service, "/text", f"Walter White,07  09  98,Mexico,{TODAY},\n".encode(),
+                        "text/csv")
+    assert status == 200
+    assert body.startswith(b"%PDF")
+
+
+def test_photo(service, pictures):
+    status, body = post(service, "/photo",
+                        [student(img_destination=os.path.join(pictures, "photo.jpg"))])
+    assert status == 200
+    assert body.startswith(b"%PDF")
+
+
+def test_bad_date(service):
+    status, body = post(service, "/text", [student(date_of_birth="1998-09-07")])
+    assert status == 400
+    assert b"invalid date of birth" in body
+
+
+def test_missing_photo(service, pictures):
+    status, body = post(service, "/photo",
+                        [student(img_destination=os.path.join(pictures, "missing.jpg"))])
+    assert status == 400
+    assert b"missing photo" in body
+
+
+def test_missing_key(service):
+    status, body = post(service, "/text", [{"name": "Walter White"}])
+    assert status == 400
+    assert b"date_of_birth" in body
+
+
+def test_photo_outside_imgpath(service):
+    status, body = post(service, "/photo",
+                        [student(img_destination=os.path.join(REPO_DIR, "README.md"))])
+    assert status == 400
+    assert b"README.md" in body
+
+
+def test_photo_traversal(service, pictures):
+    path = os.path.join(pictures, "..", "..", "etc", "passwd")
+    status, _ = post(service, "/photo", [student(img_destination=path)])
+    assert status == 400
+
+
+def test_broken_photo(service, pictures):
+    status, body = post(service, "/photo",
+                        [student(img_destination=os.path.join(pictures, "broken.jpg"))])
+    assert status == 400
+    assert b"Cannot read the photo" in body
+
+
+def test_queued_photo(service, pictures, tmp_path, monkeypatch):
+    """A photo with several faces is listed instead of printing a guess."""
+    detector = service[0].detector
+    photo = os.path.join(pictures, "photo.jpg")
+    monkeypatch.setattr(detector, "decisions", DecisionStore(str(tmp_path / "decisions.sqlite3")))
+    monkeypatch.setattr(detector, "process",
+                        lambda img_path: (None, [[0, 0, 100, 100], [200, 200, 300, 300]]))
+    status, body = post(service, "/photo", [student(img_destination=photo)])
+    assert status == 409
+    assert photo.encode() in body
+    assert [img_path for _, img_path, _ in detector.decisions.queued()] == [photo]
+
+
+def test_unknown_route(service):
+    status, _ = post(service, "/labels", [student()])
+    assert status == 404
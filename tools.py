@@ -1,4 +1,5 @@
 import argparse
+import hashlib
 import inspect
 
 def str2bool(v):
@@ -20,4 +21,12 @@ def retrieve_name(var):
         for fi in reversed(inspect.stack()):
             names = [var_name for var_name, var_val in fi.frame.f_locals.items() if var_val is var]
             if len(names) > 0:
-                return names[0]
\ No newline at end of file
+                return names[0]
+
+def file_hash(path, chunk_size: int = 1 << 20, algorithm: str = "sha256") -> str:
+    """Returns hex digest of the file contents, sha256 by default."""
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
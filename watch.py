@@ -0,0 +1,228 @@
+import argparse
+import csv
+import dataclasses
+import glob
+import hashlib
+import json
+import logging
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+from config import Config, PrintMode
+from download_images import DownloadImages
+from generate import (Generate, StudentInfo, add_detector_arguments,
+                      check_detector_arguments)
+from profiler import profiler, report as profile_report
+
+log = logging.getLogger(__name__)
+
+
+class Watch(DownloadImages):
+    """Long running mode for the intake week. Polls the form exports for new
+    rows, downloads their photos and adds the students to pending print sheets.
+    Whenever a sheet is full it is saved as a numbered PDF ready to print,
+    the partially filled sheet is kept in output/pending-<mode>.pdf.
+
+    The cascade, fonts, crop cache and detection processes stay loaded
+    between the polls, processed rows are remembered in a state file,
+    so a restart continues with the same sheets."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.generate = Generate(args)
+        self.output_dir = os.path.dirname(Config.watch_state_path)
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.layouts = {
+            PrintMode.TEXT_ONLY: self.generate.text_layout,
+            PrintMode.PHOTO_ONLY: self.generate.photo_layout,
+        }
+        self.page_sizes = {mode: make_layout(os.devnull).page_size
+                           for mode, make_layout in self.layouts.items()}
+        self.mtimes = dict()
+        self.retry = dict()
+        self.crops = dict()
+        self.new_students = list()
+        self.load_state()
+
+        self.setup(args.download_workers, resume=True, validate=False)
+        self.generate.import_legacy_decisions()
+        self.detection = None
+        if args.workers > 1:
+            self.detection = self.generate.detector.create_pool(args.workers)
+        try:
+            with ProcessPoolExecutor(max_workers=Config.workers) as self.converter:
+                self.poll()
+                while not args.once:
+                    time.sleep(args.interval)
+                    self.poll()
+        finally:
+            if self.detection is not None:
+                self.detection.shutdown()
+
+    def load_state(self) -> None:
+        self.seen = set()
+        self.pending = {mode: list() for mode in self.layouts}
+        self.sheets = {mode: 0 for mode in self.layouts}
+        if not os.path.exists(Config.watch_state_path):
+            return
+        with open(Config.watch_state_path, "r") as f:
+            state = json.load(f)
+        self.seen = set(state["seen"])
+        for mode in self.layouts:
+            self.pending[mode] = [StudentInfo(*row) for row in state["pending"][str(mode)]]
+            self.sheets[mode] = state["sheets"][str(mode)]
+
+    def save_state(self) -> None:
+        state = {
+            "seen": sorted(self.seen),
+            "pending": {str(mode): [dataclasses.astuple(student)[:5] for student in students]
+                        for mode, students in self.pending.items()},
+            "sheets": {str(mode): count for mode, count in self.sheets.items()},
+        }
+        tmp_path = f"{Config.watch_state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=1)
+        os.replace(tmp_path, Config.watch_state_path)
+
+    def csv_paths(self) -> List[str]:
+        if os.path.isdir(self.args.path):
+            return sorted(glob.glob(os.path.join(self.args.path, "*.csv")))
+        return [self.args.path]
+
+    def new_lines(self) -> Dict[str, list]:
+        """Rows of the exports that changed since the last poll which were
+        not processed before, and rows whose picture failed to download,
+        by the hash of the row."""
+        lines, self.retry = self.retry, dict()
+        for path in self.csv_paths():
+            mtime = os.path.getmtime(path)
+            if self.mtimes.get(path) == mtime:
+                continue
+            self.mtimes[path] = mtime
+            with open(path, "r") as f:
+                csv_reader = csv.reader(f)
+                next(csv_reader, None)
+                for line in csv_reader:
+                    key = hashlib.sha256("\x1f".join(line).encode()).hexdigest()
+                    if key not in self.seen:
+                        lines[key] = line
+        return lines
+
+    def poll(self) -> None:
+        lines = self.new_lines()
+        if not lines:
+            return
+        log.info(f"Found {len(lines)} new rows")
+        jobs = list()
+        self.keys = dict()
+        for key, line in lines.items():
+            try:
+                row, file_id = self.process_line(line)
+            except (ValueError, IndexError):
+                # Read again when the export changes
+                log.error(f"Skipping row {line}, fix it in the form and export it again")
+                continue
+            jobs.append((row, file_id))
+            self.keys[row[4]] = key, line
+
+        self.new_students = list()
+        self.failed.clear()
+        self.download_jobs(jobs)
+        self.report_failures()
+        if self.retry:
+            log.info(f"Trying {len(self.retry)} failed rows again in the next check")
+        self.add_students(self.new_students)
+        self.save_state()
+
+    def row_finished(self, row: list, downloaded: bool) -> list:
+        """Rows are remembered as processed only when their picture
+        was downloaded, the others are tried again in the next poll."""
+        key, line = self.keys[row[4]]
+        if not downloaded:
+            self.retry[key] = line
+            return row
+        self.seen.add(key)
+        self.new_students.append(StudentInfo(*row))
+        return row
+
+    def add_students(self, students: List[StudentInfo]) -> None:
+        """Adds the students to the pending sheets and saves every full sheet."""
+        for student in students:
+            self.pending[PrintMode.TEXT_ONLY].append(student)
+            if os.path.exists(student.img_destination):
+                self.pending[PrintMode.PHOTO_ONLY].append(student)
+            else:
+                log.warning(f"{student.name} has no picture, leaving them out of the photo sheet")
+
+        for mode, pending in self.pending.items():
+            page_size = self.page_sizes[mode]
+            while len(pending) >= page_size:
+                self.sheets[mode] += 1
+                path = os.path.join(self.output_dir,
+                                    f"sheet-{mode}-{self.sheets[mode]:03}.pdf")
+                self.draw_sheet(mode, pending[:page_size], path)
+                log.info(f"Sheet {path} is ready to print")
+                for student in pending[:page_size]:
+                    self.crops.pop(student.img_destination, None)
+                del pending[:page_size]
+
+            pending_path = os.path.join(self.output_dir, f"pending-{mode}.pdf")
+            if pending:
+                self.draw_sheet(mode, pending, pending_path)
+                log.info(f"Pending {mode} sheet has {len(pending)} of {page_size} students")
+            elif os.path.exists(pending_path):
+                os.remove(pending_path)
+
+    def draw_sheet(self, mode: PrintMode, students: List[StudentInfo], path: str) -> None:
+        layout = self.layouts[mode](path)
+        if mode == PrintMode.TEXT_ONLY:
+            layout.draw_page(students, self.generate.draw_text_block)
+        else:
+            # Crops of the pending students are kept until their sheet is full
+            missing = [student.img_destination for student in students
+                       if student.img_destination not in self.crops]
+            if missing:
+                with profiler.stage("crop_photos"):
+                    crops = self.generate.detector.run_many(missing, executor=self.detection)
+                self.crops.update(zip(missing, crops))
+            blocks = list()
+            for student in students:
+                crop = self.crops[student.img_destination]
+                crop.seek(0)
+                blocks.append((student, crop))
+            layout.draw_page(blocks, self.generate.draw_photo_block)
+        layout.save()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Watches the form exports and prepares print sheets of new students.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('path', nargs='?', default=Config.watch_path,
+                        help='Folder with CSV files exported from the application form, '
+                             'or a single CSV file.')
+    parser.add_argument('--interval', type=float, default=Config.watch_interval,
+                        help='Seconds between two checks for new rows.')
+    parser.add_argument('--once', action="store_true",
+                        help='Check for new rows only once and exit.')
+    parser.add_argument('--download-workers', type=int,
+                        default=Config.download_workers,
+                        help='Number of concurrent downloads.')
+    add_detector_arguments(parser)
+    args = parser.parse_args()
+    check_detector_arguments(parser, args)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.profile:
+        profiler.enable(args.profile_dump)
+    try:
+        Watch(args)
+    except KeyboardInterrupt:
+        log.info("Stopped watching")
+    profile_report(args.profile_top, args.profile_dump)